@@ -1,7 +1,9 @@
 import pathlib
 
-name = "app_b"
+name = "app_a"
 directory = pathlib.Path(__file__).parent / "micropython"
 globs = ["*.py", "*.txt"]
+# Only the modules imported from here are packaged
+entry_points = ["main.py"]
 
 assert directory.exists(), str(directory)
@@ -5,10 +5,24 @@ import gc
 import machine
 import micropython
 import _thread
+import asyncio
 
 
 micropython.alloc_emergency_exception_buf(100)
 
+try:
+    # Provided by the bootstrap in 'app_a/micropython' which also provides 'config_secrets'.
+    import utils_download_package
+    import utils_update
+except ImportError:
+    # Installed without the bootstrap: The dryer runs without updates.
+    utils_download_package = None
+    utils_update = None
+
+# A power cut interrupted the switch to a new version.
+if utils_download_package is not None and utils_download_package.finish_switch():
+    machine.soft_reset()
+
 import utils_wlan
 
 import utils_button
@@ -33,13 +47,27 @@ sm = Statemachine(hardware=hardware, sensoren=sensoren)
 sensoren.sensor_statemachine.set_sm(sm=sm)
 
 
-def main_core2(mqtt):
+async def main_mqtt(mqtt):
+    """
+    The only task talking to the broker.
+    """
+    if utils_download_package is not None:
+        # The metrics of the update before the reboot
+        while not await utils_download_package.publish_metrics(mqtt):
+            await asyncio.sleep_ms(utils_wlan.MQTT_POLL_MS)
+    await mqtt.run()
+
+
+async def main_core2(mqtt):
+    """
+    The control loop: Measures, controls the heater and feeds the watchdog.
+    Never awaits the network: The messages are queued for 'main_mqtt()'.
+    """
     print("DEBUG: main_core2: started")
 
     def statechange(old: str, new: str, why: str) -> None:
-        mqtt.publish_annotation(
-            title=f"Statechange: {old} -> {new}", text=f"Why: {why}"
-        )
+        # Called by 'sm.state()'
+        mqtt.queue_annotation(title=f"Statechange: {old} -> {new}", text=f"Why: {why}")
 
     sm.statechange_cb = statechange
 
@@ -51,6 +79,8 @@ def main_core2(mqtt):
 
     # logfile.log(LogfileTags.SENSORS_HEADER, sensoren.sensors.get_header())
 
+    asyncio.create_task(main_mqtt(mqtt))
+
     while True:
         sensoren.measure()
 
@@ -66,9 +96,24 @@ def main_core2(mqtt):
 
         # print("get_mqtt_fields")
         # print(sensors.get_mqtt_fields())
-        mqtt.publish(fields=sensoren.sensors.get_mqtt_fields(), tags={})
+        mqtt.queue(fields=sensoren.sensors.get_mqtt_fields(), tags={})
+
+        if updater is not None and updater.ready:
+            activate_update()
 
-        tb.sleep()
+        # 'main_mqtt()' publishes and the mqtt messages are received while sleeping
+        await tb.sleep_async()
+
+
+def activate_update() -> None:
+    """
+    The new version has been downloaded and verified in the background.
+    Only the swap and the reset interrupt the dryer.
+    """
+    print("Activate new version")
+    hardware.heater.set_power(False)
+    logfile.flush()
+    updater.activate()
 
 
 def pressed(duration_ms: int) -> None:
@@ -90,7 +135,7 @@ utils_button.Button(
 
 
 def thread():
-    _thread.start_new_thread(main_core2, ())
+    _thread.start_new_thread(asyncio.run, (main_core2(mqtt),))
 
 
 def values():
@@ -107,6 +152,10 @@ def power_off():
     wlan.power_off()
 
 
+def wlanstat():
+    mqtt.telemetry.print_events()
+
+
 def df():  # Disk Free
     print("*** Garbage")
     print(
@@ -167,8 +216,17 @@ wlan.register_wdt_feed_cb(wdt.feed)
 wlan.power_off()
 wlan.connect()
 mqtt = utils_wlan.MQTT(wlan)
+updater = None
+if utils_update is not None:
+    # Download and verify updates on the second core while the dryer keeps running.
+    updater = utils_update.Updater(wlan, push=utils_update.MQTT_TOPIC_LATEST is not None)
+    if utils_update.MQTT_TOPIC_LATEST is not None:
+        # The packager pushes new versions: Nothing is polled.
+        mqtt.register_callback(utils_update.MQTT_TOPIC_LATEST, updater.notify, absolute=True)
 
 if True:
-    main_core2(mqtt)
+    if updater is not None:
+        updater.start_thread()
+    asyncio.run(main_core2(mqtt))
 else:
-    _thread.start_new_thread(main_core2, (mqtt,))
+    _thread.start_new_thread(asyncio.run, (main_core2(mqtt),))
@@ -6,6 +6,7 @@ import time
 import machine
 import micropython
 import _thread
+import asyncio
 
 
 micropython.alloc_emergency_exception_buf(100)
@@ -56,19 +57,17 @@ def main_core1():
         time.sleep(WLAN_RECONNECT_RETRY_MS)
 
 
-def main_core2(mqtt):
+async def main_core2(mqtt):
     """
     The second core
     * runs the statemachine
     * feeds the watchdog
-    * pushes MQTT messages
+    * queues MQTT messages: The task 'mqtt.run()' pushes them
     """
     print("DEBUG: main_core2: started")
 
     def statechange(old: str, new: str, why: str) -> None:
-        mqtt.publish_annotation(
-            title=f"Statechange: {old} -> {new}", text=f"Why: {why}"
-        )
+        mqtt.queue_annotation(title=f"Statechange: {old} -> {new}", text=f"Why: {why}")
 
     sm.statechange_cb = statechange
 
@@ -80,6 +79,8 @@ def main_core2(mqtt):
 
     # logfile.log(LogfileTags.SENSORS_HEADER, sensoren.sensors.get_header())
 
+    asyncio.create_task(mqtt.run())
+
     while True:
         sensoren.measure()
 
@@ -95,9 +96,9 @@ def main_core2(mqtt):
 
         # print("get_mqtt_fields")
         # print(sensors.get_mqtt_fields())
-        mqtt.publish(fields=sensoren.sensors.get_mqtt_fields())
+        mqtt.queue(fields=sensoren.sensors.get_mqtt_fields(), tags={})
 
-        tb.sleep()
+        await tb.sleep_async()
 
 def pressed(duration_ms: int) -> None:
     sm.set_forward_to_next_state()
@@ -124,7 +125,7 @@ utils_button.Button(
 
 
 def thread():
-    _thread.start_new_thread(main_core2, ())
+    _thread.start_new_thread(asyncio.run, (main_core2(mqtt),))
 
 
 def values():
@@ -226,7 +227,7 @@ def smx(new_state: str):
 if True:
     wlan = utils_wlan.WLAN()
     mqtt = utils_wlan.MQTT(wlan)
-    _thread.start_new_thread(main_core2, [mqtt])
+    _thread.start_new_thread(asyncio.run, (main_core2(mqtt),))
     main_core1()
 else:
-    _thread.start_new_thread(main_core2, ())
+    _thread.start_new_thread(asyncio.run, (main_core2(mqtt),))
@@ -1,4 +1,5 @@
 import time
+import asyncio
 
 import config
 from utils_wdt import wdt, WDT_SLEEP_MS
@@ -31,5 +32,22 @@ class Timebase:
         self.sleep_done_ms = time.ticks_diff(time.ticks_ms(), self.start_ms)
         wdt.feed()
 
+    async def sleep_async(self):
+        """
+        Like 'sleep()', but the other tasks run meanwhile.
+        """
+        self.measure_next_ms += self.interval_ms
+
+        while True:
+            sleep_ms = self.measure_next_ms - self.now_ms
+            if sleep_ms < 0:
+                break
+            wdt.feed()
+            # Be aware of the watchdog and do not sleep to long
+            await asyncio.sleep_ms(min(sleep_ms, WDT_SLEEP_MS))
+
+        self.sleep_done_ms = time.ticks_diff(time.ticks_ms(), self.start_ms)
+        wdt.feed()
+
 
 tb = Timebase(interval_ms=config.MEASURE_INTERVAL_MS)
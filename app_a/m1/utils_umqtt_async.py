@@ -0,0 +1,278 @@
+import asyncio
+import struct
+
+# An asyncio variant of 'utils_umqtt.MQTTClient' with the same api.
+# The methods talking to the broker are coroutines. A background task
+# receives the messages: Incoming publishes, acks and pings are handled
+# while the application publishes or runs its control loop.
+# Runs on micropython and on CPython.
+
+# Seconds to wait for CONNACK, SUBACK and PUBACK.
+# Well below the watchdog timeout (8.4s) and the measure interval (10s):
+# A lost broker is detected before the next messages are queued.
+ACK_TIMEOUT_S = 3
+
+
+class MQTTException(Exception):
+    pass
+
+
+def _bytes(s):
+    return s.encode() if isinstance(s, str) else s
+
+
+def _str(s):
+    s = _bytes(s)
+    return struct.pack("!H", len(s)) + s
+
+
+def _packet(op, *parts):
+    data = b"".join(parts)
+    sz = len(data)
+    pkt = bytearray([op])
+    while sz > 0x7F:
+        pkt.append((sz & 0x7F) | 0x80)
+        sz >>= 7
+    pkt.append(sz)
+    return bytes(pkt) + data
+
+
+class MQTTClient:
+    def __init__(
+        self,
+        client_id,
+        server,
+        port=0,
+        user=None,
+        password=None,
+        keepalive=0,
+        ssl=False,
+        ssl_params={},
+    ):
+        if port == 0:
+            port = 8883 if ssl else 1883
+        self.client_id = client_id
+        # The stream while connected
+        self.sock = None
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        # Not used: 'asyncio.open_connection()' takes no ssl parameters on micropython
+        self.ssl_params = ssl_params
+        self.pid = 0
+        self.cb = None
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_qos = 0
+        self.lw_retain = False
+        self._reader = None
+        self._write_lock = asyncio.Lock()
+        # pid -> [event, payload of the ack]
+        self._acks = {}
+        self._received = asyncio.Event()
+        # Messages delivered to the callback but not yet returned by 'wait_msg()'
+        self._pending = 0
+        self._error = None
+        self._tasks = []
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        assert topic
+        self.lw_topic = topic
+        self.lw_msg = msg
+        self.lw_qos = qos
+        self.lw_retain = retain
+
+    def _next_pid(self):
+        self.pid = self.pid % 0xFFFF + 1
+        return self.pid
+
+    async def _write(self, pkt):
+        async with self._write_lock:
+            if self.sock is None:
+                raise self._error or OSError(-1)
+            self.sock.write(pkt)
+            await self.sock.drain()
+
+    def _fail(self, e):
+        """
+        The connection is lost: Wakes up all waiting coroutines.
+        """
+        if self._error is None:
+            self._error = e
+        for ack in self._acks.values():
+            ack[0].set()
+        self._received.set()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _expect_ack(self, pid):
+        # Registered before the packet is sent: The ack might arrive before we wait.
+        self._acks[pid] = [asyncio.Event(), None]
+
+    async def _wait_ack(self, pid):
+        ack = self._acks[pid]
+        try:
+            await asyncio.wait_for(ack[0].wait(), ACK_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            raise OSError("MQTT ack timeout")
+        finally:
+            del self._acks[pid]
+        if ack[1] is None:
+            raise self._error
+        return ack[1]
+
+    async def connect(self, clean_session=True):
+        self._reader, self.sock = await asyncio.open_connection(
+            self.server, self.port, ssl=True if self.ssl else None
+        )
+        self._error = None
+        self._pending = 0
+        try:
+            flags = clean_session << 1
+            payload = [_str(self.client_id)]
+            if self.lw_topic:
+                flags |= 0x4 | self.lw_qos << 3 | self.lw_retain << 5
+                payload += [_str(self.lw_topic), _str(self.lw_msg)]
+            if self.user is not None:
+                flags |= 0xC0
+                payload += [_str(self.user), _str(self.pswd)]
+            assert self.keepalive < 65536
+            msg = b"\x00\x04MQTT\x04" + bytes([flags]) + struct.pack("!H", self.keepalive)
+            await self._write(_packet(0x10, msg, *payload))
+            try:
+                resp = await asyncio.wait_for(self._reader.readexactly(4), ACK_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                raise OSError("MQTT connack timeout")
+            assert resp[0] == 0x20 and resp[1] == 0x02
+            if resp[3] != 0:
+                raise MQTTException(resp[3])
+        except Exception as e:
+            self._fail(e)
+            raise
+        self._tasks = [asyncio.create_task(self._receive())]
+        if self.keepalive:
+            self._tasks.append(asyncio.create_task(self._ping_periodically()))
+        return resp[2] & 1
+
+    async def disconnect(self):
+        try:
+            await self._write(b"\xe0\0")
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            self._tasks = []
+            self._fail(OSError(-1))
+
+    async def ping(self):
+        await self._write(b"\xc0\0")
+
+    async def _ping_periodically(self):
+        while self.sock is not None:
+            await asyncio.sleep(self.keepalive / 2)
+            try:
+                await self.ping()
+            except OSError:
+                return
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        assert qos < 2
+        parts = [_str(topic)]
+        if qos > 0:
+            pid = self._next_pid()
+            parts.append(struct.pack("!H", pid))
+            self._expect_ack(pid)
+        parts.append(_bytes(msg))
+        try:
+            await self._write(_packet(0x30 | qos << 1 | retain, *parts))
+        except Exception:
+            if qos > 0:
+                del self._acks[pid]
+            raise
+        if qos == 1:
+            await self._wait_ack(pid)
+
+    async def subscribe(self, topic, qos=0):
+        assert self.cb is not None, "Subscribe callback is not set"
+        pid = self._next_pid()
+        self._expect_ack(pid)
+        try:
+            await self._write(
+                _packet(0x82, struct.pack("!H", pid), _str(topic), bytes([qos]))
+            )
+        except Exception:
+            del self._acks[pid]
+            raise
+        resp = await self._wait_ack(pid)
+        if resp[0] == 0x80:
+            raise MQTTException(resp[0])
+
+    async def _receive(self):
+        # The background task: Reads and processes the incoming packets.
+        try:
+            while True:
+                op = (await self._reader.readexactly(1))[0]
+                sz = 0
+                sh = 0
+                while True:
+                    b = (await self._reader.readexactly(1))[0]
+                    sz |= (b & 0x7F) << sh
+                    if not b & 0x80:
+                        break
+                    sh += 7
+                data = await self._reader.readexactly(sz) if sz else b""
+                await self._process(op, data)
+        except EOFError:
+            self._fail(OSError(-1))
+        except Exception as e:
+            # Also exceptions raised by the callback: 'check_msg()' raises them.
+            self._fail(e)
+
+    async def _process(self, op, data):
+        kind = op & 0xF0
+        if kind == 0x30:  # PUBLISH
+            topic_len = data[0] << 8 | data[1]
+            topic = data[2 : 2 + topic_len]
+            pos = 2 + topic_len
+            if op & 6:
+                pid = data[pos : pos + 2]
+                pos += 2
+            self.cb(topic, data[pos:])
+            self._pending += 1
+            self._received.set()
+            if op & 6 == 2:
+                await self._write(b"\x40\x02" + pid)
+            elif op & 6 == 4:
+                assert 0
+        elif kind in (0x40, 0x90):  # PUBACK, SUBACK
+            ack = self._acks.get(data[0] << 8 | data[1], None)
+            if ack is not None:
+                ack[1] = data[2:]
+                ack[0].set()
+        # PINGRESP: Nothing to do
+
+    # Waits until the background task delivered a message to the callback
+    # set by .set_callback() method. Returns immediately for each message
+    # delivered since the last call: For example a retained message which
+    # arrived together with the SUBACK.
+    async def wait_msg(self):
+        self.check_msg()
+        while self._pending == 0:
+            self._received.clear()
+            await self._received.wait()
+            self.check_msg()
+        self._pending -= 1
+
+    # The messages are received in the background: Returns immediately.
+    # Raises the error if the connection was lost.
+    def check_msg(self):
+        if self._error is not None:
+            raise self._error
+        return None
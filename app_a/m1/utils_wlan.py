@@ -1,7 +1,11 @@
 import time
+import _thread
+import array
+import asyncio
+import binascii
 import rp2
 import network
-from utils_umqtt import MQTTClient
+from utils_umqtt_async import MQTTClient, MQTTException
 
 import secrets
 import utils_influxdb
@@ -13,14 +17,53 @@ network.country(country)
 
 
 WLAN_CONNECT_TIME_OUT_MS = const(10000)
+# Reconnecting to the known access point takes some 100ms.
+WLAN_RECONNECT_TIME_OUT_MS = const(3000)
+WLAN_POLL_MS = const(50)
+# The scan results are reused for reconnects within this time.
+WLAN_SCAN_TTL_MS = const(60000)
+# Another access point has to be stronger by this to replace the last good one.
+WLAN_PREFER_LAST_BSSID_DB = const(8)
+# Time between power off and power on
+WLAN_POWER_OFF_MS = const(1000)
+# The wait after a failed attempt doubles up to the maximum.
+WLAN_BACKOFF_MIN_MS = const(1000)
+WLAN_BACKOFF_MAX_MS = const(32000)
 
+# The states of 'WLAN.tick()'
+STATE_IDLE = const(0)
+STATE_SCANNING = const(1)
+STATE_ASSOCIATING = const(2)
+STATE_GOT_IP = const(3)
+STATE_BACKOFF = const(4)
+STATE_NAMES = ("idle", "scanning", "associating", "got-ip", "backoff")
 
 class WLAN:
     def __init__(self):
         self._wdt_feed = lambda: False
+        self._event_cb = lambda duration_ms, ssid_index, rssi, status: None
         self._wlan = network.WLAN(network.STA_IF)
         self._wlan.config(pm=network.WLAN.PM_PERFORMANCE)
         self.connection_counter = 0
+        # (ssid, password, bssid, channel) of the last successful connection
+        self._last_network = None
+        # One core drives the state machine: See 'tick()', 'connect()' and 'power_off()'
+        self._lock = _thread.allocate_lock()
+        self.state = STATE_IDLE
+        self._state_ms = time.ticks_ms()
+        self._backoff_ms = WLAN_BACKOFF_MIN_MS
+        self._candidate = None
+        self._reconnecting = False
+        self._timeout_ms = 0
+        self._attempt_ms = 0
+        self._scan_results = None
+        self._scan_ms = 0
+        # Set by 'tick()', done by 'scan()'
+        self._scan_requested = False
+        # The bssid of the last successful connection: Preferred by '_find_ssid()'
+        self._good_bssid = None
+        # The selected network and why: Exported as metrics
+        self.selection = None
         # time.sleep(1.0)
         # print(f"DEBUG: reset 2: {self._wlan.isconnected()}, {self._wlan.status()}")
 
@@ -31,6 +74,15 @@ class WLAN:
         """
         self._wdt_feed = wdt_feed_cb
 
+    def register_event_cb(self, event_cb):
+        """
+        'event_cb(duration_ms, ssid_index, rssi, status)' is called at the end
+        of every connection attempt, successful or not.
+        ssid_index: Index into SSID_CREDENTIALS or -1 if no known network was found.
+        status: 'network.STAT_GOT_IP' on success.
+        """
+        self._event_cb = event_cb
+
     def power_on(self) -> None:
         """
         Power of the WLAN interface
@@ -47,7 +99,18 @@ class WLAN:
         Sometimes a WLAN connection is dangeling in a unwanted state.
         `power_off()` normally recovers and allows us to create a brand
         new connection.
+        Does nothing while the other core is connecting: It would
+        power off below the running attempt which recovers by itself.
         """
+        if not self._lock.acquire(0):
+            print("DEBUG: WLAN power_off() skipped: The other core is connecting")
+            return
+        try:
+            self._power_off()
+        finally:
+            self._lock.release()
+
+    def _power_off(self) -> None:
         # print(f"DEBUG: interface_stop 1: {self.status_text}")
         self._wlan.disconnect()
         # print(f"DEBUG: interface_stop 2: {self.status_text}")
@@ -78,28 +141,76 @@ class WLAN:
     def ip_address(self):
         return self._wlan.ifconfig()[0]
 
-    def _find_ssid(self):
+    def _scan(self) -> None:
         """
-        returns (ssid, password)
-        or (None, None)
+        Powers on and scans: Blocks for 1 to 3s.
+        The scan results are reused for WLAN_SCAN_TTL_MS.
         """
-        # Scan the wlan
         self._wdt_feed()
-        set_ssids = {l[0] for l in self._wlan.scan()}
+        self.power_on()
+        if self._scan_results is not None:
+            if time.ticks_diff(time.ticks_ms(), self._scan_ms) < WLAN_SCAN_TTL_MS:
+                return
+        self._wdt_feed()
+        results = self._wlan.scan()
+        self._scan_results = results if len(results) > 0 else None
+        self._scan_ms = time.ticks_ms()
+
+    def _find_ssid(self):
+        """
+        returns (ssid, password, bssid, channel)
+        or None
 
-        if len(set_ssids) == 0:
+        Selects from the results of the last '_scan()'.
+        The known access point with the strongest signal is selected.
+        The last good access point is kept unless another is stronger by WLAN_PREFER_LAST_BSSID_DB.
+        """
+        results = self._scan_results
+
+        if results is None:
             print("WARNING: WLANs.scan() returned empty list!")
-            return (None, None)
+            return None
 
-        for ssid, password in secrets.SSID_CREDENTIALS:
+        dict_passwords = {}
+        for index, (ssid, password) in enumerate(secrets.SSID_CREDENTIALS):
             assert isinstance(ssid, bytes), ssid
             assert isinstance(password, str), password
-            if ssid in set_ssids:
-                print(f"DEBUG: selected network: {ssid}")
-                return (ssid, password)
+            dict_passwords[ssid] = (index, password)
+
+        strongest = None
+        last_good = None
+        candidates = 0
+        for l in results:
+            # (ssid, bssid, channel, RSSI, security, hidden)
+            if l[0] not in dict_passwords:
+                continue
+            candidates += 1
+            if (strongest is None) or (l[3] > strongest[3]):
+                strongest = l
+            if l[1] == self._good_bssid:
+                last_good = l
 
-        print("WARNING: WLANs.scan(): No matching network seen!")
-        return (None, None)
+        if strongest is None:
+            print("WARNING: WLANs.scan(): No matching network seen!")
+            return None
+
+        selected, reason = strongest, "strongest"
+        if last_good is not None:
+            if last_good[3] + WLAN_PREFER_LAST_BSSID_DB >= strongest[3]:
+                selected, reason = last_good, "last_bssid"
+        ssid, bssid, channel, rssi = selected[:4]
+        index, password = dict_passwords[ssid]
+        self.selection = {
+            "ssid": ssid.decode(),
+            "index": index,
+            "bssid": binascii.hexlify(bssid).decode(),
+            "channel": channel,
+            "rssi": rssi,
+            "reason": reason,
+            "candidates": candidates,
+        }
+        print(f"DEBUG: selected network: {self.selection}")
+        return (ssid, password, bssid, channel)
 
     @property
     def ip_address(self):
@@ -117,62 +228,344 @@ class WLAN:
             return False
         return self.ip_address != "0.0.0.0"
 
-    def connect(self) -> bool:
+    def _switch(self, state: int) -> None:
+        # print(f"DEBUG: WLAN {STATE_NAMES[self.state]} -> {STATE_NAMES[state]}")
+        self.state = state
+        self._state_ms = time.ticks_ms()
+
+    @property
+    def _state_duration_ms(self) -> int:
+        return time.ticks_diff(time.ticks_ms(), self._state_ms)
+
+    def _start_scanning(self) -> None:
         """
-        Return True if connection could be established
+        Power cycle the interface: 'scan()' follows after WLAN_POWER_OFF_MS.
         """
-        try:
+        print(f"DEBUG: connecting WLAN ...")
+        self._attempt_ms = time.ticks_ms()
+        self._power_off()
+        self._scan_requested = True
+        self._switch(STATE_SCANNING)
+
+    def _associate(self, candidate, reconnect: bool) -> None:
+        """
+        reconnect: Connect to the access point of the last connection:
+          No power cycle and no scan.
+        """
+        ssid, password, bssid, channel = candidate
+        self._candidate = candidate
+        self._reconnecting = reconnect
+        if reconnect:
+            print(f"DEBUG: reconnecting WLAN '{ssid}' ...")
+            self._attempt_ms = time.ticks_ms()
+            if not self._wlan.active():
+                self.power_on()
+            if self.selection is not None:
+                self.selection["reason"] = "reconnect"
+            self._timeout_ms = WLAN_RECONNECT_TIME_OUT_MS
+        else:
+            print(f"DEBUG: connecting WLAN '{ssid}' ...")
+            self._timeout_ms = WLAN_CONNECT_TIME_OUT_MS
+        # The bssid selects the access point if several share the ssid
+        self._wlan.connect(ssid, password, bssid=bssid, channel=channel)
+        self._switch(STATE_ASSOCIATING)
+
+    def _event(self, status: int, selection) -> None:
+        """
+        The end of a connection attempt: See 'register_event_cb()'.
+        """
+        ssid_index, rssi = -1, 0
+        if selection is not None:
+            ssid_index, rssi = selection["index"], selection["rssi"]
+        duration_ms = time.ticks_diff(time.ticks_ms(), self._attempt_ms)
+        self._event_cb(duration_ms, ssid_index, rssi, status)
+
+    def _backoff(self) -> None:
+        print(f"DEBUG: WLAN retry in {self._backoff_ms}ms")
+        self._switch(STATE_BACKOFF)
+
+    def _tick_associating(self) -> None:
+        duration_ms = self._state_duration_ms
+        ssid = self._candidate[0]
+        if self.got_ip_address:
+            print(
+                f"DEBUG: Connected within {duration_ms}ms to {ssid} and ip {self.ip_address}"
+            )
+            self.connection_counter += 1
+            self._last_network = self._candidate
+            self._good_bssid = self._candidate[2]
+            if self.selection is not None:
+                try:
+                    self.selection["rssi"] = self._wlan.status("rssi")
+                except (ValueError, OSError):
+                    pass
+            self._backoff_ms = WLAN_BACKOFF_MIN_MS
+            self._switch(STATE_GOT_IP)
+            self._event(network.STAT_GOT_IP, self.selection)
+            return
+        status = self._wlan.status()
+        if status < 0:
+            print(f"WARNING: Connection to {ssid} failed: {self.get_status_name(status)}")
+        elif duration_ms > self._timeout_ms:
+            print(f"WARNING: Timeout of {duration_ms}ms while waiting for connection!")
+        else:
+            return
+        self._event(status, self.selection)
+        # The access point is not what the scan told: Scan again next time.
+        self._scan_results = None
+        if self._candidate[2] == self._good_bssid:
+            self._good_bssid = None
+        if self._reconnecting:
+            # The access point might have gone: Do the full procedure.
+            self._last_network = None
+            self._start_scanning()
+            return
+        self._backoff()
+
+    def _tick(self) -> None:
+        if self.state == STATE_GOT_IP:
             if self.got_ip_address:
-                return True
-            print(f"DEBUG: connecting WLAN ...")
-            self._wdt_feed()
-            self.power_off()
-            time.sleep(1)
-            self.power_on()
-            ssid, password = self._find_ssid()
-            if ssid is None:
+                return
+            print("WARNING: WLAN connection lost!")
+            self._switch(STATE_IDLE)
+
+        if self.state == STATE_IDLE:
+            if self.got_ip_address:
+                self._switch(STATE_GOT_IP)
+            elif self._last_network is not None:
+                self._associate(self._last_network, reconnect=True)
+            else:
+                self._start_scanning()
+            return
+
+        if self.state == STATE_SCANNING:
+            if self._scan_requested:
+                # Waiting for 'scan()'
+                return
+            candidate = self._find_ssid()
+            if candidate is None:
                 # print("WARNING: No known SSID!")
-                return False
-            print(f"DEBUG: connecting WLAN '{ssid:s}' ...")
+                self._event(self._wlan.status(), None)
+                self._backoff()
+                return
+            self._associate(candidate, reconnect=False)
+            return
+
+        if self.state == STATE_ASSOCIATING:
+            self._tick_associating()
+            return
+
+        if self.state == STATE_BACKOFF:
+            if self._state_duration_ms < self._backoff_ms:
+                return
+            self._backoff_ms = min(2 * self._backoff_ms, WLAN_BACKOFF_MAX_MS)
+            self._switch(STATE_IDLE)
+
+    def tick(self) -> bool:
+        """
+        Advances the connection by one step and returns True if we have a ip address.
+        Never waits: The control loop may call this on every iteration.
+        The blocking 'active(True)' and 'scan()' of the driver are left to 'scan()':
+        'tick()' only uses the results.
+        """
+        if not self._lock.acquire(0):
+            # The other core is connecting
+            return self.state == STATE_GOT_IP
+        try:
+            self._step(self._tick)
+        finally:
+            self._lock.release()
+        return self.state == STATE_GOT_IP
+
+    def scan(self) -> None:
+        """
+        Powers on and scans if 'tick()' asks for it: Blocks for 1 to 3s, once per full
+        connection attempt. Otherwise returns at once.
+        Call it between the iterations of the control loop, for example from the mqtt task.
+        """
+        if not self._lock.acquire(0):
+            # The other core is connecting
+            return
+        try:
+            self._step(self._scan_if_requested)
+        finally:
+            self._lock.release()
+
+    def _scan_if_requested(self) -> None:
+        if self.state != STATE_SCANNING or not self._scan_requested:
+            return
+        if self._state_duration_ms < WLAN_POWER_OFF_MS:
+            return
+        self._scan()
+        self._scan_requested = False
+
+    def _step(self, method) -> None:
+        try:
             self._wdt_feed()
-            self._wlan.connect(ssid, password)
-            start_ms = time.ticks_ms()
+            method()
+        except OSError as e:
+            print(f"ERROR: wlan.connect() failed: {e}")
+            self._last_network = None
+            self._backoff()
+
+    def connect(self) -> bool:
+        """
+        Return True if connection could be established
+
+        Blocks until connected or the attempt failed. Loops which must not block call 'tick()'.
+        If there was a connection before, we first try to reconnect to the same access point.
+        Only if this fails, the interface is power cycled and the wlan scanned.
+        The lock is held for the whole attempt: Meanwhile 'tick()' and 'power_off()'
+        of the other core return at once and do not touch the interface.
+        """
+        with self._lock:
+            if self.state == STATE_BACKOFF:
+                # An explicit connect does not wait
+                self._switch(STATE_IDLE)
             while True:
-                self._wdt_feed()
-                duration_ms = time.ticks_diff(time.ticks_ms(), start_ms)
-                if self.got_ip_address:
-                    break
-                if duration_ms > WLAN_CONNECT_TIME_OUT_MS:
-                    print(
-                        f"WARNING: Timeout of {duration_ms}ms while waiting for connection!"
-                    )
+                self._step(self._scan_if_requested)
+                self._step(self._tick)
+                if self.state == STATE_GOT_IP:
+                    return True
+                if self.state == STATE_BACKOFF:
                     return False
-                time.sleep(1)
+                time.sleep_ms(WLAN_POLL_MS)
+
+
+# The number of connection attempts kept by 'Telemetry'
+TELEMETRY_EVENTS = const(32)
+TELEMETRY_PUBLISH_INTERVAL_MS = const(600000)
+DURATION_HOUR_MS = const(3600000)
+
+
+def _percentile(sorted_values: list, percent: int):
+    """
+    Nearest rank: None if there are no values.
+    """
+    if len(sorted_values) == 0:
+        return None
+    rank = (len(sorted_values) * percent + 99) // 100
+    return sorted_values[max(rank, 1) - 1]
+
+
+class Telemetry:
+    """
+    A ring of the last TELEMETRY_EVENTS connection attempts of 'WLAN'.
+    The events are stored in fixed size arrays: Recording does not allocate.
+    """
+
+    def __init__(self, wlan: WLAN):
+        self._wlan = wlan
+        self._ticks_ms = array.array("i", [0] * TELEMETRY_EVENTS)
+        self._duration_ms = array.array("i", [0] * TELEMETRY_EVENTS)
+        self._ssid_index = array.array("b", [0] * TELEMETRY_EVENTS)
+        self._rssi = array.array("b", [0] * TELEMETRY_EVENTS)
+        self._status = array.array("b", [0] * TELEMETRY_EVENTS)
+        self._next = 0
+        self._count = 0
+        wlan.register_event_cb(self.record)
+
+    def record(self, duration_ms: int, ssid_index: int, rssi: int, status: int) -> None:
+        i = self._next
+        self._ticks_ms[i] = time.ticks_ms()
+        self._duration_ms[i] = duration_ms
+        self._ssid_index[i] = ssid_index
+        self._rssi[i] = rssi
+        self._status[i] = status
+        self._next = (i + 1) % TELEMETRY_EVENTS
+        self._count = min(self._count + 1, TELEMETRY_EVENTS)
+
+    def _reason(self, i: int) -> str:
+        if self._ssid_index[i] < 0:
+            return "NO_KNOWN_SSID"
+        return self._wlan.get_status_name(self._status[i])
+
+    def summary(self) -> dict:
+        """
+        connect_p50_ms/connect_p95_ms: Of the successful attempts in the ring.
+        failures_per_hour: The failed attempts within the last hour.
+        last_failure: The reason of the most recent failed attempt.
+        """
+        now_ms = time.ticks_ms()
+        durations_ms = []
+        failures_per_hour = 0
+        last_failure = None
+        # Oldest event first
+        for n in range(self._count):
+            i = (self._next - self._count + n) % TELEMETRY_EVENTS
+            if self._status[i] == network.STAT_GOT_IP:
+                durations_ms.append(self._duration_ms[i])
+                continue
+            last_failure = self._reason(i)
+            if time.ticks_diff(now_ms, self._ticks_ms[i]) < DURATION_HOUR_MS:
+                failures_per_hour += 1
+        durations_ms.sort()
+        return {
+            "attempts": self._count,
+            "connect_p50_ms": _percentile(durations_ms, 50),
+            "connect_p95_ms": _percentile(durations_ms, 95),
+            "failures_per_hour": failures_per_hour,
+            "last_failure": last_failure,
+        }
+
+    def print_events(self) -> None:
+        now_ms = time.ticks_ms()
+        for n in range(self._count):
+            i = (self._next - self._count + n) % TELEMETRY_EVENTS
+            age_s = time.ticks_diff(now_ms, self._ticks_ms[i]) // 1000
             print(
-                f"DEBUG: Connected within {duration_ms}ms to {ssid} and ip {self.ip_address}"
+                f"-{age_s}s: {self._duration_ms[i]}ms ssid_index={self._ssid_index[i]} rssi={self._rssi[i]}dBm {self._reason(i)}"
             )
-            self.connection_counter += 1
-            return True
-        except OSError as e:
-            print(f"ERROR: wlan.connect() failed: {e}")
-            return False
+        print(self.summary())
 
 
 # CLIENT_ID = ubinascii.hexlify(machine.unique_id())
 PUBLISH_TOPIC = b"forward2influxdb"
 INITIAL_VALUE = b"dummy"
+# The messages queued while the broker is not reachable: The oldest are dropped.
+MQTT_QUEUE_LENGTH = const(16)
+MQTT_POLL_MS = const(100)
 
 
 class MQTT:
+    """
+    The methods talking to the broker are coroutines: The messages are
+    received in the background while the control loop runs.
+    The control loop does not await them: It calls 'queue()' and 'run()'
+    is the task which connects and publishes.
+    """
+
     def __init__(self, wlan: WLAN):
         self.client = None
         self.wlan = wlan
+        # 'run()' and the callers of 'publish()' may connect concurrently: Only one connects.
+        self._connect_lock = asyncio.Lock()
         self._callbacks = {}
+        self._absolute_topics = set()
         self.wlan_connection_counter = -1
+        self._selection_connection_counter = -1
+        self.telemetry = Telemetry(wlan)
+        self._telemetry_ms = time.ticks_ms()
+        # (fields, tags, qos) to be published by 'run()'
+        self._queue = []
+        self._last_access_ms = time.ticks_ms()
 
-    def register_callback(self, subtopic: str, cb):
-        topic = f"filament_dryer/{secrets.MQTT_CLIENT_ID}/{subtopic}".encode()
-        self._callbacks[topic] = cb
+    @property
+    def duration_since_last_access_ms(self) -> int:
+        """
+        The time since the broker was reached the last time.
+        """
+        return time.ticks_diff(time.ticks_ms(), self._last_access_ms)
+
+    def register_callback(self, subtopic: str, cb, absolute=False):
+        """
+        absolute: 'subtopic' is the complete topic, not below this device.
+          For example the retained messages published by the packager.
+        """
+        topic = subtopic if absolute else f"filament_dryer/{secrets.MQTT_CLIENT_ID}/{subtopic}"
+        self._callbacks[topic.encode()] = cb
+        if absolute:
+            self._absolute_topics.add(topic.encode())
 
     def _callback(self, topic: bytes, msg: bytes):
         if msg == INITIAL_VALUE:
@@ -183,8 +576,14 @@ class MQTT:
             return
         cb(msg.decode("ascii"))
 
-    def connect(self):
-        if not self.wlan.connect():
+    async def connect(self) -> bool:
+        async with self._connect_lock:
+            return await self._connect()
+
+    async def _connect(self) -> bool:
+        # The only blocking step of the connection: Runs outside the control loop.
+        self.wlan.scan()
+        if not self.wlan.tick():
             return False
         # print("DEBUG: MQTT connect...")
         if self.wlan_connection_counter == self.wlan.connection_counter:
@@ -192,6 +591,12 @@ class MQTT:
         print(
             f"DEBUG: WLAN reconnected (connection_counter:{self.wlan.connection_counter}). MQTT has to reconnect too..."
         )
+        if self.client is not None:
+            # Stops the background tasks of the lost connection
+            try:
+                await self.client.disconnect()
+            except Exception:
+                pass
         self.client = None
         self.wlan_connection_counter = self.wlan.connection_counter
 
@@ -212,17 +617,20 @@ class MQTT:
         # print(f"DEBUG: MQTT Broker '{secrets.MQTT_BROKER}'")
         try:
             self.wlan._wdt_feed()
-            self.client.connect()
-        except OSError as e:
+            await self.client.connect()
+            # self.client.subscribe(SUBSCRIBE_TOPIC)
+            # self.client.publish(SUBSCRIBE_TOPIC, "Off")
+            for topic in self._callbacks:
+                self.wlan._wdt_feed()
+                await self.client.subscribe(topic)
+                if topic in self._absolute_topics:
+                    # Do not disturb other subscribers
+                    continue
+                self.wlan._wdt_feed()
+                await self.client.publish(topic, INITIAL_VALUE)
+        except (OSError, MQTTException) as e:
             print(f"ERROR: MQTT connect() failed: {e}")
             return False
-        # self.client.subscribe(SUBSCRIBE_TOPIC)
-        # self.client.publish(SUBSCRIBE_TOPIC, "Off")
-        for topic in self._callbacks:
-            self.wlan._wdt_feed()
-            self.client.subscribe(topic)
-            self.wlan._wdt_feed()
-            self.client.publish(topic, INITIAL_VALUE)
 
         # Avoid recursion!
         # self.wlan._wdt_feed()
@@ -231,9 +639,52 @@ class MQTT:
         print(f"DEBUG: MQTT connected to {secrets.MQTT_BROKER}")
         return True
 
-    def publish(self, fields: dict, tags: dict) -> None:
-        if not self.connect():
-            return
+    def queue(self, fields: dict, tags: dict, qos=0) -> None:
+        """
+        Never waits: The message is published by 'run()'.
+        """
+        if len(self._queue) >= MQTT_QUEUE_LENGTH:
+            print("WARNING: MQTT queue full: Dropped the oldest message")
+            self._queue.pop(0)
+        self._queue.append((fields, tags, qos))
+
+    def queue_annotation(self, title: str, text: str, severity="INFO") -> None:
+        self.queue(fields=self._annotation_fields(title, text), tags=self._annotation_tags(severity))
+
+    async def publish_queued(self) -> bool:
+        """
+        Publishes the messages of 'queue()' in order.
+        Returns True if the queue is empty. A failed message stays queued.
+        """
+        while len(self._queue) > 0:
+            fields, tags, qos = self._queue[0]
+            if not await self.publish(fields=fields, tags=tags, qos=qos):
+                return False
+            self._queue.pop(0)
+        return True
+
+    async def run(self) -> None:
+        """
+        The mqtt task: Keeps the connection and publishes the queued messages.
+        The control loop continues while this task waits for the network.
+        """
+        while True:
+            await self.publish_queued()
+            await asyncio.sleep_ms(MQTT_POLL_MS)
+
+    async def publish(self, fields: dict, tags: dict, qos=0) -> bool:
+        """
+        Returns True if the payload was sent.
+        qos=1: Only True if the broker acknowledged the payload.
+        """
+        if not await self.connect():
+            return False
+        if self._selection_connection_counter != self.wlan.connection_counter:
+            self._selection_connection_counter = self.wlan.connection_counter
+            await self.publish_wlan_selection()
+        if time.ticks_diff(time.ticks_ms(), self._telemetry_ms) > TELEMETRY_PUBLISH_INTERVAL_MS:
+            self._telemetry_ms = time.ticks_ms()
+            await self.publish_wlan_telemetry()
         tags["setup"] = "zeus"
         tags["room"] = "B15"
         measurements = [
@@ -249,26 +700,71 @@ class MQTT:
             print(payload)
         try:
             self.wlan._wdt_feed()
-            self.client.publish(PUBLISH_TOPIC, payload)
-        except OSError as e:
+            await self.client.publish(PUBLISH_TOPIC, payload, qos=qos)
+        except (OSError, MQTTException) as e:
             print(f"ERROR: MQTT publish() failed: {e}")
             self.wlan.power_off()
-            return
+            return False
+        self._last_access_ms = time.ticks_ms()
         try:
             self.wlan._wdt_feed()
             self.client.check_msg()
-        except OSError as e:
+        except (OSError, MQTTException) as e:
             print(f"ERROR: MQTT check_msg() failed: {e}")
             self.wlan.power_off()
+        return True
+
+    async def publish_wlan_selection(self) -> None:
+        """
+        The network selected by 'WLAN._find_ssid()' and why.
+        """
+        selection = self.wlan.selection
+        if selection is None:
             return
+        fields = {
+            "wlan_ssid": f'"{selection["ssid"]}"',
+            "wlan_bssid": f'"{selection["bssid"]}"',
+            "wlan_channel": str(selection["channel"]),
+            "wlan_rssi_dBm": str(selection["rssi"]),
+            "wlan_candidates": str(selection["candidates"]),
+        }
+        tags = {
+            "event": "wlan",
+            "reason": selection["reason"],
+        }
+        await self.publish(fields=fields, tags=tags)
 
-    def publish_annotation(self, title: str, text: str, severity="INFO") -> None:
+    async def publish_wlan_telemetry(self) -> None:
+        """
+        See 'Telemetry.summary()'.
+        """
+        summary = self.telemetry.summary()
         fields = {
+            "wlan_attempts": str(summary["attempts"]),
+            "wlan_failures_per_hour": str(summary["failures_per_hour"]),
+        }
+        if summary["connect_p50_ms"] is not None:
+            fields["wlan_connect_p50_ms"] = str(summary["connect_p50_ms"])
+            fields["wlan_connect_p95_ms"] = str(summary["connect_p95_ms"])
+        if summary["last_failure"] is not None:
+            fields["wlan_last_failure"] = f'"{summary["last_failure"]}"'
+        await self.publish(fields=fields, tags={"event": "wlan_telemetry"})
+
+    @staticmethod
+    def _annotation_fields(title: str, text: str) -> dict:
+        return {
             "title": f'"{title}"',
             "text": f'"{text}"',
         }
-        tags = {
+
+    @staticmethod
+    def _annotation_tags(severity: str) -> dict:
+        return {
             "severity": severity,
             "event": "annotation",
         }
-        self.publish(fields=fields, tags=tags)
+
+    async def publish_annotation(self, title: str, text: str, severity="INFO", qos=0) -> bool:
+        fields = self._annotation_fields(title, text)
+        tags = self._annotation_tags(severity)
+        return await self.publish(fields=fields, tags=tags, qos=qos)
@@ -54,6 +54,12 @@ class FileSection:
     def skip(self):
         sz = self.content_len + self.align
         if sz:
+            try:
+                # Files may seek, streams (sockets, decompressors) have to be read.
+                self.f.seek(sz, 1)
+                return
+            except (AttributeError, OSError):
+                pass
             buf = bytearray(16)
             while sz:
                 s = min(sz, 16)
@@ -85,6 +91,7 @@ class TarFile:
         self.subf = None
         self.mode = mode
         self.offset = 0
+        self._index = None
         if mode == "r":
             if fileobj:
                 self.f = fileobj
@@ -119,6 +126,7 @@ class TarFile:
         self.offset += len(buf)
         d = TarInfo(str(h.name, "utf-8").rstrip("\0"))
         d.size = int(bytes(h.size), 8)
+        d.offset_data = self.offset
         self.subf = d.subf = FileSection(self.f, d.size, _roundup(d.size, _BLOCKSIZE))
         self.offset += _roundup(d.size, _BLOCKSIZE)
         return d
@@ -132,7 +140,30 @@ class TarFile:
             raise StopIteration
         return v
 
+    def index(self):
+        """
+        Returns {name: (offset, size)} for all members, 'offset' is the start of the content.
+        The headers are read in a single pass, the contents are skipped.
+        Requires a seekable file object.
+        """
+        if self._index is None:
+            self.f.seek(0)
+            self.offset = 0
+            self.subf = None
+            self._index = {}
+            for i in self:
+                self._index[i.name] = (i.offset_data, i.size)
+        return self._index
+
     def extractfile(self, tarinfo):
+        """
+        'tarinfo' may also be a member name: The member is located using index().
+        """
+        if isinstance(tarinfo, str):
+            offset, size = self.index()[tarinfo]
+            self.f.seek(offset)
+            self.subf = None
+            return FileSection(self.f, size, _roundup(size, _BLOCKSIZE))
         return tarinfo.subf
 
     def close(self):
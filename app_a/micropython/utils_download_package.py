@@ -1,5 +1,8 @@
+import io
 import os
-import urequests
+import gc
+import time
+import utils_http
 import machine
 import hashlib
 import tarfile
@@ -8,6 +11,20 @@ import binascii
 import config_secrets
 
 TAR_FILENAME = const("config_package.tar")
+FILENAME_MANIFEST = const("config_package_manifest.json")
+FILENAME_CHECKPOINT = const("config_package_checkpoint.json")
+# Written atomically once the new version is staged completely: The switch to the new version.
+FILENAME_SWITCH = const("config_package_switch.json")
+# The metrics of the last update: Published by the app after the reboot.
+FILENAME_METRICS = const("config_package_metrics.json")
+# Smaller tars are extracted while downloading. Bigger tars are saved first and may be resumed.
+STREAMING_MAX_BYTES = const(16384)
+DOWNLOAD_RETRIES = const(5)
+# One buffer of this size is used for downloading and extracting: Independent of the file sizes.
+BUFFER_BYTES = const(1024)
+# Starts with 'config_': Will not be removed by '_remove_obsolete_files()'.
+STAGING_DIRECTORY = const("config_staging")
+_S_IFDIR = const(0x4000)
 
 
 # class _DirCacheObsolete:
@@ -53,69 +70,795 @@ TAR_FILENAME = const("config_package.tar")
 #         assert False, ex
 
 
-def _save_response_to_file(response, chunk_size=2048):
+class Metrics:
+    """
+    Wall time and bytes of the update phases: check, download, hash, extract, cleanup.
+    The bytes of 'check' and 'download' are received, of 'hash' read and of 'extract' written.
+    'cleanup' counts the files moved instead of bytes.
+    Streamed tars are extracted while downloading: This is all in 'download'.
+    Also records the peak of 'gc.mem_alloc()' and the retries.
+    """
+
+    def __init__(self):
+        self.retries = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Called before every update check: The retries are kept.
+        """
+        self.link = None
+        self.phases = {}
+        self.mem_alloc_peak = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self._phase = None
+        self._start_ms = 0
+        self._start_bytes = 0
+
+    def start(self, phase: str) -> None:
+        self._phase = phase
+        self._start_ms = time.ticks_ms()
+        self._start_bytes = utils_http.client.bytes_received
+        self.sample()
+
+    def stop(self, size_bytes=None) -> None:
+        """
+        'size_bytes' None: The bytes received since 'start()'.
+        """
+        duration_ms = time.ticks_diff(time.ticks_ms(), self._start_ms)
+        if size_bytes is None:
+            size_bytes = utils_http.client.bytes_received - self._start_bytes
+        phase = self.phases.setdefault(self._phase, [0, 0])
+        phase[0] += duration_ms
+        phase[1] += size_bytes
+        self.sample()
+
+    def sample(self) -> None:
+        mem_alloc = gc.mem_alloc()
+        if mem_alloc > self.mem_alloc_peak:
+            self.mem_alloc_peak = mem_alloc
+
+    def save(self) -> None:
+        with open(FILENAME_METRICS, "w") as f:
+            json.dump(
+                {
+                    "link": self.link,
+                    "phases": self.phases,
+                    "mem_alloc_peak": self.mem_alloc_peak,
+                    "retries": self.retries,
+                    "bytes_skipped": self.bytes_skipped,
+                },
+                f,
+            )
+
+
+metrics = Metrics()
+
+
+async def publish_metrics(mqtt) -> bool:
+    """
+    To be called by the app after the reboot:
+    Publishes the metrics of the last update as annotation and removes them.
+    'mqtt' is a 'utils_wlan.MQTT'.
+    Returns True if nothing is left to publish: Call again until the broker acknowledged.
+    """
+    try:
+        with open(FILENAME_METRICS, "r") as f:
+            dict_metrics = json.load(f)
+    except OSError:
+        return True
+    phases = ", ".join(
+        f"{name} {duration_ms}ms {size}{' files' if name == 'cleanup' else 'B'}"
+        for name, (duration_ms, size) in dict_metrics["phases"].items()
+    )
+    link = dict_metrics["link"]
+    bytes_skipped = dict_metrics["bytes_skipped"]
+    mem_alloc_peak = dict_metrics["mem_alloc_peak"]
+    retries = dict_metrics["retries"]
+    text = f"{link}: {phases}, {bytes_skipped}B unchanged, peak heap {mem_alloc_peak}B, retries {retries}"
+    if not await mqtt.publish_annotation(title="Update", text=text, qos=1):
+        return False
+    os.remove(FILENAME_METRICS)
+    return True
+
+
+class _Throughput:
+    """
+    Prints the throughput and the heap allocated while downloading through 'buf':
+    Use it to tune the size of 'buf'.
+    All downloads read into 'buf': Full reads do not allocate. Only a short
+    read (the last one, a slow connection) allocates a memoryview slice.
+    This keeps the gc pauses short while the control loop runs on the other core.
+    """
+
+    def __init__(self, buf: bytearray):
+        self._buf_bytes = len(buf)
+        self._mem_alloc_start = gc.mem_alloc()
+        self._start_ms = time.ticks_ms()
+        self._start_bytes = utils_http.client.bytes_received
+
+    def report(self, name: str) -> None:
+        duration_ms = max(1, time.ticks_diff(time.ticks_ms(), self._start_ms))
+        size_bytes = utils_http.client.bytes_received - self._start_bytes
+        mem_alloc_bytes = gc.mem_alloc() - self._mem_alloc_start
+        kbytes_s = size_bytes // duration_ms
+        print(
+            f"{name}: {size_bytes} bytes in {duration_ms}ms: {kbytes_s}kB/s, buffer {self._buf_bytes} bytes, heap allocated {mem_alloc_bytes} bytes"
+        )
+
+
+def _save_response_to_file(response, buf: bytearray) -> str:
+    """
+    Saves the response to TAR_FILENAME and returns its sha256.
+    """
     # https://github.com/SpotlightKid/mrequests/
+    mv = memoryview(buf)
+    throughput = _Throughput(buf)
     with open(TAR_FILENAME, "wb") as f:
         hash = hashlib.sha256()
 
         while True:
-            chunk = response.raw.read(chunk_size)
-            if not chunk:
+            size = response.raw.readinto(buf)
+            if not size:
                 break
+            chunk = buf if size == len(buf) else mv[:size]
             hash.update(chunk)
             f.write(chunk)
+            metrics.sample()
+
+        response.raw.close()
+    throughput.report(TAR_FILENAME)
+    return binascii.hexlify(hash.digest()).decode("ascii")
+
+
+class _HashingStream(io.IOBase):
+    """
+    Wraps a stream and calculates the sha256 of all bytes read.
+    Derived from 'io.IOBase': Only then 'deflate.DeflateIO' accepts it
+    as stream. The decompressor reads through 'readinto()'.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+
+    def read(self, size):
+        data = self._f.read(size)
+        self._hash.update(data)
+        return data
+
+    def readinto(self, buf, size=None):
+        if (size is not None) and (size < len(buf)):
+            buf = memoryview(buf)[:size]
+        size = self._f.readinto(buf)
+        if size:
+            # Only a short read needs a slice
+            self._hash.update(buf if size == len(buf) else memoryview(buf)[:size])
+        return size
+
+    def drain(self, buf):
+        """
+        Read the rest of the stream: The tar parser stops at the first empty block.
+        """
+        while self.readinto(buf):
+            pass
+
+    def hexdigest(self):
+        return binascii.hexlify(self._hash.digest()).decode("ascii")
+
+
+def _read_checkpoint(dict_tar: dict) -> int:
+    """
+    Returns the number of bytes of TAR_FILENAME which have already been verified.
+    """
+    try:
+        with open(FILENAME_CHECKPOINT, "r") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if checkpoint["sha256"] != dict_tar["sha256"]:
+        # The checkpoint belongs to another download
+        return 0
+    offset = checkpoint["offset"]
+    if _file_size(TAR_FILENAME) < offset:
+        # The partial tar was truncated or removed: Start over.
+        print(f"{FILENAME_CHECKPOINT}: {TAR_FILENAME} is shorter than {offset} bytes")
+        os.remove(FILENAME_CHECKPOINT)
+        return 0
+    return offset
+
+
+def _write_checkpoint(dict_tar: dict, offset: int) -> None:
+    with open(FILENAME_CHECKPOINT, "w") as f:
+        json.dump({"sha256": dict_tar["sha256"], "offset": offset}, f)
+
 
+def _download_resume(dict_tar: dict, chunk_sha256s: list, buf: bytearray) -> None:
+    """
+    Continues the download of TAR_FILENAME at the checkpoint using a 'Range' request.
+    The checkpoint is updated after every verified chunk:
+    The bytes of a chunk which fails will be overwritten when resuming.
+    Raises OSError if the connection drops.
+    The reads stop at the chunk boundaries: If 'buf' divides the chunk size,
+    only short reads allocate. Every chunk allocates its sha256 object:
+    The hashlib of micropython cannot be reset.
+    """
+    size_bytes = dict_tar["size_bytes"]
+    chunk_size = dict_tar["chunk_size"]
+    offset = _read_checkpoint(dict_tar)
+    if offset >= size_bytes:
+        return
+
+    headers = {"Range": f"bytes={offset}-"}
+    response = utils_http.get(_url(dict_tar["link"]), headers=headers)
+    try:
+        if response.status_code == 200:
+            # The server ignored the 'Range' header
+            offset = 0
+        elif response.status_code != 206:
+            raise OSError(f"status_code={response.status_code}")
+        if offset > 0:
+            print(f"{dict_tar['link']}: Resume at {offset} of {size_bytes} bytes")
+
+        mv = memoryview(buf)
+        with open(TAR_FILENAME, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            while offset < size_bytes:
+                chunk_end = min(offset + chunk_size, size_bytes)
+                hash = hashlib.sha256()
+                pos = offset
+                while pos < chunk_end:
+                    size = response.raw.readinto(buf, min(len(buf), chunk_end - pos))
+                    if not size:
+                        raise OSError("connection closed")
+                    part = buf if size == len(buf) else mv[:size]
+                    hash.update(part)
+                    f.write(part)
+                    pos += size
+                    metrics.sample()
+                sha256 = binascii.hexlify(hash.digest()).decode("ascii")
+                if sha256 != chunk_sha256s[offset // chunk_size]:
+                    raise OSError(f"chunk at {offset}: sha256 mismatch")
+                f.flush()
+                offset = chunk_end
+                _write_checkpoint(dict_tar, offset)
+    finally:
         response.raw.close()
-        return binascii.hexlify(hash.digest()).decode("ascii")
 
 
-def _unpack_tarfile():
-    t = tarfile.TarFile(TAR_FILENAME)
+def _save_resumable(dict_tar: dict, buf: bytearray) -> bool:
+    """
+    Downloads the tar into TAR_FILENAME.
+    If the connection drops, the download continues after the last verified chunk.
+    This also works after a reboot: The offset is persisted in FILENAME_CHECKPOINT.
+    Returns True if the sha256 of the tar matches.
+    """
+    response = utils_http.get(_url(dict_tar["link_chunks"]))
+    if response.status_code != 200:
+        response.close()
+        raise OSError(f"{dict_tar['link_chunks']}: status_code={response.status_code}")
+    chunk_sha256s = response.text.split()
+    response.close()
+
+    metrics.start("download")
+    throughput = _Throughput(buf)
+    for retry in range(DOWNLOAD_RETRIES):
+        try:
+            _download_resume(dict_tar, chunk_sha256s, buf)
+            break
+        except OSError as e:
+            print(f"{dict_tar['link']}: Download interrupted ({retry=}): {e}")
+            metrics.retries += 1
+    else:
+        metrics.stop()
+        return False
+    metrics.stop()
+    throughput.report(dict_tar["link"])
+
+    # The chunks are verified. Verify the file on flash as a whole.
+    metrics.start("hash")
+    hash = hashlib.sha256()
+    mv = memoryview(buf)
+    with open(TAR_FILENAME, "rb") as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            hash.update(buf if size == len(buf) else mv[:size])
+    metrics.stop(dict_tar["size_bytes"])
+    os.remove(FILENAME_CHECKPOINT)
+    sha256 = binascii.hexlify(hash.digest()).decode("ascii")
+    sha256_expected = dict_tar["sha256"]
+    if sha256 != sha256_expected:
+        print(f"{TAR_FILENAME}: {sha256=} {sha256_expected=}!")
+        os.remove(TAR_FILENAME)
+        return False
+    return True
+
+
+def _rmtree(directory: str) -> None:
+    try:
+        entries = list(os.ilistdir(directory))
+    except OSError:
+        # The directory does not exist
+        return
+    for entry in entries:
+        name = f"{directory}/{entry[0]}"
+        if entry[1] == _S_IFDIR:
+            _rmtree(name)
+        else:
+            os.remove(name)
+    os.rmdir(directory)
+
+
+def _makedirs_for_file(filename: str) -> None:
+    """
+    Creates the directories of 'filename' if they do not exist.
+    """
+    parts = filename.split("/")[:-1]
+    for i in range(1, len(parts) + 1):
+        try:
+            os.mkdir("/".join(parts[:i]))
+        except OSError:
+            # The directory already exists
+            pass
+
+
+def _commit_staging(names: list) -> None:
+    """
+    Moves the files 'names' from STAGING_DIRECTORY into place.
+    May be repeated after a power cut: Files already moved are skipped.
+    """
+    for name in names:
+        _makedirs_for_file(name)
+        if name.endswith("/"):
+            continue
+        filename_staged = f"{STAGING_DIRECTORY}/{name}"
+        if _exists(filename_staged):
+            os.rename(filename_staged, name)
+    _rmtree(STAGING_DIRECTORY)
+
+
+def _url(link: str) -> str:
+    return f"{config_secrets.URL_APP}/{link}"
+
+
+def _decompress(f, wbits: int):
+    """
+    Returns a stream which decompresses the zlib stream 'f' while reading.
+    Requires a buffer of 2**wbits bytes.
+    """
+    try:
+        import deflate
+
+        return deflate.DeflateIO(f, deflate.ZLIB, wbits)
+    except ImportError:
+        # micropython < 1.21
+        import zlib
+
+        return zlib.DecompIO(f, wbits)
+
+
+def _read_dict_files(filename: str) -> dict:
+    """
+    Returns 'dict_files' of the manifest 'filename' or {} if not available.
+    """
+    try:
+        with open(filename, "r") as f:
+            return json.load(f).get("dict_files", {})
+    except OSError:
+        return {}
+
+
+def _exists(filename: str) -> bool:
+    try:
+        os.stat(filename)
+        return True
+    except OSError:
+        return False
+
+
+def _file_size(filename: str) -> int:
+    """
+    Returns -1 if 'filename' does not exist.
+    """
+    try:
+        return os.stat(filename)[6]
+    except OSError:
+        return -1
+
+
+def _copy(f, of, mv, size_bytes: int) -> None:
+    """
+    Copies 'size_bytes' from 'f' to 'of' through the buffer 'mv'.
+    """
+    while size_bytes > 0:
+        size = f.readinto(mv[: min(len(mv), size_bytes)])
+        of.write(mv[:size])
+        size_bytes -= size
+
+
+def _extract_member(f, size_bytes: int, filename: str, buf: bytearray, filename_installed: str) -> bool:
+    """
+    Copies the member 'f' through 'buf': No member is loaded as a whole.
+    While the member equals 'filename_installed', nothing is written:
+    The first half of 'buf' is compared with the second half read from 'filename_installed'.
+    Returns False if the member is unchanged and 'filename' has not been written.
+    """
+    mv = memoryview(buf)
+    half = len(buf) // 2
+    size = 0
+    size_equal = 0
+    if _file_size(filename_installed) == size_bytes:
+        with open(filename_installed, "rb") as fi:
+            while True:
+                size = f.readinto(mv[:half])
+                if not size:
+                    return False
+                fi.readinto(mv[half : half + size])
+                if mv[:size] != mv[half : half + size]:
+                    break
+                size_equal += size
+
+    # The packager writes no directory members: 'lib/b3.py' comes without 'lib/'.
+    _makedirs_for_file(filename)
+    with open(filename, "wb") as of:
+        if size_equal:
+            # The beginning of the member equals the installed file.
+            with open(filename_installed, "rb") as fi:
+                _copy(fi, of, mv[half:], size_equal)
+        if size:
+            of.write(mv[:size])
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            of.write(buf if size == len(buf) else mv[:size])
+            metrics.sample()
+    return True
+
+
+def _print_written(dict_tar: dict, bytes_written: int, bytes_skipped: int) -> None:
+    metrics.bytes_written += bytes_written
+    metrics.bytes_skipped += bytes_skipped
+    print(f"{dict_tar['link']}: {bytes_written} bytes written, {bytes_skipped} bytes unchanged")
+
+
+def _unpack_tarfile(f_tar, dict_tar: dict, directory: str, buf: bytearray) -> list:
+    """
+    Extracts the tar stream 'f_tar' into 'directory'.
+    Members equal to the installed files are not written.
+    Returns the names of the extracted members.
+    """
+    if dict_tar.get("compression", None) == "zlib":
+        f_tar = _decompress(f_tar, dict_tar["wbits"])
+    names = []
+    bytes_written = bytes_skipped = 0
+    t = tarfile.TarFile(fileobj=f_tar)
     for i in t:
+        filename = f"{directory}/{i.name}"
         if i.type == tarfile.DIRTYPE:
-            os.mkdir(i.name)
+            _makedirs_for_file(filename)
+            names.append(i.name)
+            continue
+        if not _extract_member(t.extractfile(i), i.size, filename, buf, i.name):
+            bytes_skipped += i.size
+            continue
+        print(f"  {dict_tar['link']}: {i.name}")
+        bytes_written += i.size
+        names.append(i.name)
+    _print_written(dict_tar, bytes_written, bytes_skipped)
+    return names
+
+
+def _unpack_tarfile_indexed(f_tar, dict_tar: dict, directory: str, buf: bytearray) -> list:
+    """
+    Extracts the uncompressed tar file 'f_tar' into 'directory' using the member index.
+    The manifest is read first: Members which did not change since
+    the installed manifest are skipped. The manifest is written last.
+    Returns the names of the extracted members.
+    """
+    t = tarfile.TarFile(fileobj=f_tar)
+    index = t.index()
+    dict_files = {}
+    if FILENAME_MANIFEST in index:
+        manifest = t.extractfile(FILENAME_MANIFEST).read()
+        dict_files = json.loads(manifest).get("dict_files", {})
+    dict_files_installed = _read_dict_files(FILENAME_MANIFEST)
+
+    names = []
+    bytes_written = bytes_skipped = 0
+    for name, (_offset, size_bytes) in index.items():
+        if name == FILENAME_MANIFEST:
+            continue
+        filename = f"{directory}/{name}"
+        if name.endswith("/"):
+            _makedirs_for_file(filename)
+            names.append(name)
+            continue
+        sha256 = dict_files.get(name, {}).get("sha256", None)
+        if sha256 is not None:
+            if sha256 == dict_files_installed.get(name, {}).get("sha256", None):
+                if _file_size(name) == size_bytes:
+                    bytes_skipped += size_bytes
+                    continue
+        if not _extract_member(t.extractfile(name), size_bytes, filename, buf, name):
+            bytes_skipped += size_bytes
             continue
-        f = t.extractfile(i)
-        print(f"  {TAR_FILENAME}: {i.name}")
-        with open(i.name, "wb") as of:
-            of.write(f.read())
+        print(f"  {dict_tar['link']}: {name}")
+        bytes_written += size_bytes
+        names.append(name)
+    if FILENAME_MANIFEST in index:
+        filename = f"{directory}/{FILENAME_MANIFEST}"
+        size_bytes = index[FILENAME_MANIFEST][1]
+        f = t.extractfile(FILENAME_MANIFEST)
+        if _extract_member(f, size_bytes, filename, buf, FILENAME_MANIFEST):
+            bytes_written += size_bytes
+            names.append(FILENAME_MANIFEST)
+        else:
+            bytes_skipped += size_bytes
+    _print_written(dict_tar, bytes_written, bytes_skipped)
+    return names
+
+
+def _unpack_tarfile_saved(dict_tar: dict, buf: bytearray) -> list:
+    """
+    Extracts TAR_FILENAME into STAGING_DIRECTORY.
+    Uncompressed tars are seekable and use the member index.
+    Returns the names of the extracted members.
+    """
+    metrics.start("extract")
+    _rmtree(STAGING_DIRECTORY)
+    os.mkdir(STAGING_DIRECTORY)
+    with open(TAR_FILENAME, "rb") as f_tar:
+        if dict_tar.get("compression", None) == "zlib":
+            names = _unpack_tarfile(f_tar, dict_tar, STAGING_DIRECTORY, buf)
+        else:
+            names = _unpack_tarfile_indexed(f_tar, dict_tar, STAGING_DIRECTORY, buf)
+    metrics.stop(metrics.bytes_written)
+    return names
+
+
+def _download_streaming(response, dict_tar: dict, buf: bytearray):
+    """
+    Extracts the tar while downloading into STAGING_DIRECTORY.
+    Returns the names of the staged files or None if the sha256 does not match.
+    """
+    _rmtree(STAGING_DIRECTORY)
+    os.mkdir(STAGING_DIRECTORY)
+
+    throughput = _Throughput(buf)
+    stream = _HashingStream(response.raw)
+    try:
+        names = _unpack_tarfile(stream, dict_tar, STAGING_DIRECTORY, buf)
+        stream.drain(buf)
+    except (OSError, ValueError) as e:
+        print(f"{dict_tar['link']}: Download failed: {e}")
+        names = None
+    response.raw.close()
+    # Includes the extraction: The tar headers and the files written allocate too.
+    throughput.report(dict_tar["link"])
+
+    sha256 = stream.hexdigest()
+    sha256_expected = dict_tar["sha256"]
+    if (names is None) or (sha256 != sha256_expected):
+        print(f"{dict_tar['link']}: {sha256=} {sha256_expected=}!")
+        _rmtree(STAGING_DIRECTORY)
+        return None
+
+    return names
+
+
+def _download_file(link: str, sha256_expected: str, filename: str, buf: bytearray) -> bool:
+    """
+    Downloads 'link' into 'filename'.
+    Returns True if the sha256 matches.
+    """
+    response = utils_http.get(_url(link))
+    if response.status_code != 200:
+        print(f"{link}: status_code={response.status_code}!")
+        response.close()
+        return False
+    _makedirs_for_file(filename)
+    stream = _HashingStream(response.raw)
+    mv = memoryview(buf)
+    with open(filename, "wb") as f:
+        while True:
+            size = stream.readinto(buf)
+            if not size:
+                break
+            f.write(buf if size == len(buf) else mv[:size])
+    response.raw.close()
+    sha256 = stream.hexdigest()
+    if sha256 != sha256_expected:
+        print(f"{link}: {sha256=} {sha256_expected=}!")
+        return False
+    return True
+
+
+def _download_files(dict_tar: dict, buf: bytearray):
+    """
+    Compares the manifest 'dict_tar' with the installed manifest
+    and downloads only the files whose sha256 differ into STAGING_DIRECTORY.
+    Returns the names of the staged files or None on failure.
+    """
+    dict_files_installed = _read_dict_files(FILENAME_MANIFEST)
+
+    _rmtree(STAGING_DIRECTORY)
+    os.mkdir(STAGING_DIRECTORY)
+    filename_manifest = f"{STAGING_DIRECTORY}/{FILENAME_MANIFEST}"
+    if not _download_file(dict_tar["link"], dict_tar["sha256"], filename_manifest, buf):
+        _rmtree(STAGING_DIRECTORY)
+        return None
+    with open(filename_manifest, "r") as f:
+        dict_files = json.load(f)["dict_files"]
+
+    names = []
+    bytes_written = bytes_skipped = 0
+    for name, dict_file in dict_files.items():
+        dict_file_installed = dict_files_installed.get(name, None)
+        if dict_file_installed is not None:
+            if dict_file_installed["sha256"] == dict_file["sha256"]:
+                bytes_skipped += dict_file["size_bytes"]
+                continue
+        link = dict_tar["link_files"] + dict_file["sha256"]
+        print(f"  {link}: {name}")
+        filename = f"{STAGING_DIRECTORY}/{name}"
+        if not _download_file(link, dict_file["sha256"], filename, buf):
+            _rmtree(STAGING_DIRECTORY)
+            return None
+        bytes_written += dict_file["size_bytes"]
+        names.append(name)
+
+    # The manifest comes last: It marks the update as complete.
+    names.append(FILENAME_MANIFEST)
+    print(f"{dict_tar['link']}: {len(names) - 1} of {len(dict_files)} files changed")
+    _print_written(dict_tar, bytes_written, bytes_skipped)
+    return names
 
 
 def _remove_obsolete_files():
-    with open("config_package_manifest.json", "r") as f:
+    with open(FILENAME_MANIFEST, "r") as f:
         files = json.load(f)["files"]
+    # The top directories of 'lib/b3.py': Obsolete files in subdirectories are kept.
+    directories = [file.split("/")[0] for file in files if "/" in file]
 
-    for file in os.listdir():
+    if "main.mpy" in files:
+        # Keep the patch below: A delta package might not contain 'main.mpy'.
+        files.extend(("main2.mpy", "main.py"))
+
+    for entry in list(os.ilistdir()):
+        file = entry[0]
         if file.startswith("config_"):
             continue
         if file in files:
             continue
+        if file in directories:
+            continue
         print(f"Remove file {file}")
-        os.remove(file)
+        if entry[1] == _S_IFDIR:
+            _rmtree(file)
+        else:
+            os.remove(file)
 
-    if "main.mpy" in files:
+    if "main.mpy" in os.listdir():
         print("'main.mpy' will not be started by micropython. Add patch!")
-        os.rename("main.mpy", "main2.mpy")
+        # 'main.mpy' is renamed last: A power cut in between repeats the patch.
         with open("main.py", "w") as f:
             f.write("import main2\n")
+        os.rename("main.mpy", "main2.mpy")
+
+
+def _download_tar(dict_tar: dict, streaming: bool, buf: bytearray):
+    """
+    Returns the names of the staged files or None on failure.
+    """
+    if not streaming and "link_chunks" in dict_tar:
+        if not _save_resumable(dict_tar, buf):
+            return None
+        return _unpack_tarfile_saved(dict_tar, buf)
 
+    metrics.start("download")
+    response = utils_http.get(_url(dict_tar["link"]))
+    if response.status_code != 200:
+        response.close()
+        raise OSError(f"{dict_tar['link']}: status_code={response.status_code}")
 
-def download_new_version(dict_tar: dict) -> None:
-    url = f"{config_secrets.URL_APP}/{dict_tar['link']}"
-    print(f"Download new package from: {url}")
-    response = urequests.get(url, stream=True)
-    assert response.status_code == 200, response.status_code
+    if streaming:
+        names = _download_streaming(response, dict_tar, buf)
+        metrics.stop()
+        return names
 
-    sha256 = _save_response_to_file(response)
+    sha256 = _save_response_to_file(response, buf)
+    metrics.stop()
     sha256_expected = dict_tar["sha256"]
     if sha256 != sha256_expected:
         print(f"{TAR_FILENAME}: {sha256=} {sha256_expected=}!")
         os.remove(TAR_FILENAME)
-        return
+        return None
+
+    return _unpack_tarfile_saved(dict_tar, buf)
+
+
+def prepare_new_version(dict_tar: dict, streaming=None, buffer_bytes=BUFFER_BYTES):
+    """
+    Downloads and verifies the new version into STAGING_DIRECTORY.
+    The installed version is not touched: The application may keep running.
+    If 'dict_tar' is a manifest, only the changed files are downloaded.
+    streaming: True: Extract the tar while downloading. Requires no space for the tar.
+      False: Save the tar to TAR_FILENAME first. Interrupted downloads will be resumed.
+      None: Stream tars up to STREAMING_MAX_BYTES.
+    buffer_bytes: The size of the one buffer used for downloading and extracting.
+    Returns the names of the staged files or None on failure.
+    """
+    print(f"Download new package from: {_url(dict_tar['link'])}")
+    if streaming is None:
+        streaming = dict_tar["size_bytes"] <= STREAMING_MAX_BYTES
 
-    _unpack_tarfile()
+    metrics.link = dict_tar["link"]
+    buf = bytearray(buffer_bytes)
+    if "link_files" in dict_tar:
+        metrics.start("download")
+        names = _download_files(dict_tar, buf)
+        metrics.stop()
+        return names
+    return _download_tar(dict_tar, streaming, buf)
 
+
+def _switch(names: list) -> None:
+    """
+    Moves the staged files into place and removes FILENAME_SWITCH.
+    May be repeated after a power cut.
+    """
+    _commit_staging(names)
     _remove_obsolete_files()
+    os.remove(FILENAME_SWITCH)
+    os.sync()
+
 
+def finish_switch() -> bool:
+    """
+    To be called at boot: Finishes a switch interrupted by a power cut.
+    Returns True if a switch was finished: The caller should reset.
+    """
+    try:
+        with open(FILENAME_SWITCH, "r") as f:
+            names = json.load(f)["names"]
+    except OSError:
+        return False
+    print(f"{FILENAME_SWITCH}: Finish the interrupted switch")
+    _switch(names)
+    return True
+
+
+def activate_new_version(names: list) -> None:
+    """
+    Moves the files staged by 'prepare_new_version()' into place and resets.
+    Unchanged files are not part of 'names': They stay in place.
+    Once FILENAME_SWITCH is written, 'finish_switch()' will complete the switch after a power cut.
+    Before, the installed version is untouched.
+    """
+    metrics.start("cleanup")
     os.sync()
+    filename_tmp = FILENAME_SWITCH + ".tmp"
+    with open(filename_tmp, "w") as f:
+        json.dump({"names": names}, f)
+    os.sync()
+    # The rename is atomic: This is the switch.
+    os.rename(filename_tmp, FILENAME_SWITCH)
+    _switch(names)
+    metrics.stop(len(names))
+    metrics.save()
+
     machine.soft_reset()
+
+
+def download_new_version(dict_tar: dict, streaming=None, buffer_bytes=BUFFER_BYTES) -> None:
+    """
+    Downloads, verifies and activates the new version: See 'prepare_new_version()'.
+    """
+    names = prepare_new_version(dict_tar, streaming=streaming, buffer_bytes=buffer_bytes)
+    if names is None:
+        return
+    activate_new_version(names)
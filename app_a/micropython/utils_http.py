@@ -0,0 +1,292 @@
+"""
+A small HTTP/1.1 client which keeps the connection open.
+
+The update check and the download use the same server: Reusing one
+connection saves the DNS lookup and the TCP (and TLS) setup per request.
+The api is the subset of 'urequests' used by the bootstrap.
+"""
+
+import json
+import socket
+
+TIMEOUT_S = const(10)
+_PORTS = {"http:": 80, "https:": 443}
+
+
+class _Connection:
+    """
+    One socket to 'host'. 'f' is the stream to read and write.
+    """
+
+    def __init__(self, address, host: str, https: bool):
+        self.reused = False
+        self.keep_alive = False
+        self._sock = socket.socket()
+        try:
+            self._sock.settimeout(TIMEOUT_S)
+            self._sock.connect(address)
+            if https:
+                import ssl
+
+                self.f = ssl.wrap_socket(self._sock, server_hostname=host)
+            else:
+                self.f = self._sock.makefile("rwb", 0)
+        except OSError:
+            self._sock.close()
+            raise
+
+    def readline(self) -> bytes:
+        line = self.f.readline()
+        if not line:
+            raise OSError("connection closed")
+        return line
+
+    def close(self) -> None:
+        self._sock.close()
+
+
+class _Body:
+    """
+    Reads the body of one response.
+    The length is given by 'Content-Length', by 'Transfer-Encoding: chunked'
+    or, if none of both, by the server closing the connection.
+    """
+
+    def __init__(self, client, connection: _Connection, length, chunked: bool):
+        self._client = client
+        self._connection = connection
+        self._remaining = length
+        self._chunked = chunked
+        self.done = False
+        if chunked:
+            self._remaining = 0
+            self._next_chunk()
+        elif length == 0:
+            self._finish()
+
+    def _next_chunk(self) -> None:
+        if self._remaining == 0 and self._chunked:
+            self._remaining = int(self._connection.readline().split(b";")[0], 16)
+            if self._remaining == 0:
+                # Trailers end with an empty line
+                while self._connection.readline() != b"\r\n":
+                    pass
+                self._finish()
+
+    def _finish(self) -> None:
+        self.done = True
+        self._client._release(self._connection)
+
+    def readinto(self, buf, size=None) -> int:
+        if self.done:
+            return 0
+        if size is None:
+            size = len(buf)
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+        # Only a partial read needs a slice: Full reads do not allocate.
+        size = self._connection.f.readinto(buf if size == len(buf) else memoryview(buf)[:size])
+        if not size:
+            if self._remaining is not None:
+                raise OSError("connection closed")
+            # The server closed the connection: The end of the body.
+            self._client._discard(self._connection)
+            self.done = True
+            return 0
+        self._client.bytes_received += size
+        if self._remaining is not None:
+            self._remaining -= size
+            if self._remaining == 0:
+                if self._chunked:
+                    self._connection.readline()
+                    self._next_chunk()
+                else:
+                    self._finish()
+        return size
+
+    def read(self, size=-1) -> bytes:
+        """
+        Blocks until 'size' bytes are read or the body ends.
+        """
+        if size < 0:
+            data = b""
+            while True:
+                chunk = self.read(1024)
+                if not chunk:
+                    return data
+                data += chunk
+        buf = bytearray(size)
+        pos = 0
+        while pos < size:
+            n = self.readinto(memoryview(buf)[pos:])
+            if not n:
+                break
+            pos += n
+        return bytes(buf) if pos == size else bytes(buf[:pos])
+
+    def close(self) -> None:
+        """
+        A body which was not read completely cannot be skipped: The connection is closed.
+        """
+        if not self.done:
+            self.done = True
+            self._client._discard(self._connection)
+
+
+class Response:
+    def __init__(self, status_code: int, headers: dict, raw: _Body):
+        self.status_code = status_code
+        self.headers = headers
+        self.raw = raw
+        self._content = None
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            self._content = self.raw.read()
+            self.raw.close()
+        return self._content
+
+    @property
+    def text(self) -> str:
+        return str(self.content, "utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self) -> None:
+        self.raw.close()
+
+
+class HttpClient:
+    """
+    Keeps one connection open and caches the dns lookups.
+    """
+
+    def __init__(self):
+        # The bytes of all bodies received: Used for the update metrics.
+        self.bytes_received = 0
+        self._addresses = {}
+        self._connection = None
+        self._connection_key = None
+
+    def _address(self, host: str, port: int):
+        key = (host, port)
+        address = self._addresses.get(key, None)
+        if address is None:
+            address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][-1]
+            self._addresses[key] = address
+        return address
+
+    def _connect(self, scheme: str, host: str, port: int) -> _Connection:
+        key = (scheme, host, port)
+        if self._connection is not None:
+            if self._connection_key == key:
+                self._connection.reused = True
+                connection = self._connection
+                self._connection = None
+                return connection
+            self._connection.close()
+            self._connection = None
+        try:
+            connection = _Connection(self._address(host, port), host, scheme == "https:")
+        except OSError:
+            # The ip address might have changed
+            self._addresses.pop((host, port), None)
+            raise
+        self._connection_key = key
+        return connection
+
+    def _release(self, connection: _Connection) -> None:
+        """
+        The response is complete: The connection may be reused.
+        """
+        if connection.keep_alive:
+            self._connection = connection
+        else:
+            connection.close()
+
+    def _discard(self, connection: _Connection) -> None:
+        connection.close()
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _request(self, connection: _Connection, host: str, path: str, headers: dict):
+        request = [f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"]
+        for key, value in headers.items():
+            request.append(f"{key}: {value}\r\n")
+        request.append("\r\n")
+        connection.f.write("".join(request).encode("utf-8"))
+
+        status_line = connection.readline().split(None, 2)
+        version = status_line[0]
+        status_code = int(status_line[1])
+        response_headers = {}
+        while True:
+            line = connection.readline()
+            if line == b"\r\n":
+                break
+            key, _, value = str(line, "utf-8").partition(":")
+            response_headers[key.strip()] = value.strip()
+        return version, status_code, response_headers
+
+    def get(self, url: str, headers=None) -> Response:
+        """
+        The body is read lazily from 'response.raw'.
+        The response has to be read completely or closed before the next request.
+        """
+        scheme, _, host, path = url.split("/", 3)
+        port = _PORTS[scheme]
+        if ":" in host:
+            host, port = host.split(":", 1)
+            port = int(port)
+        if headers is None:
+            headers = {}
+
+        connection = self._connect(scheme, host, port)
+        try:
+            try:
+                version, status_code, response_headers = self._request(
+                    connection, host, "/" + path, headers
+                )
+            except OSError:
+                if not connection.reused:
+                    raise
+                # The server closed the idle connection: Retry once with a new connection.
+                connection.close()
+                connection = self._connect(scheme, host, port)
+                version, status_code, response_headers = self._request(
+                    connection, host, "/" + path, headers
+                )
+        except Exception:
+            connection.close()
+            raise
+
+        dict_lower = {key.lower(): value for key, value in response_headers.items()}
+        keep_alive = dict_lower.get("connection", "").lower()
+        if version == b"HTTP/1.0":
+            connection.keep_alive = keep_alive == "keep-alive"
+        else:
+            connection.keep_alive = keep_alive != "close"
+
+        chunked = dict_lower.get("transfer-encoding", "").lower() == "chunked"
+        length = dict_lower.get("content-length", None)
+        if length is not None:
+            length = int(length)
+        if (status_code in (204, 304)) or (100 <= status_code < 200):
+            length, chunked = 0, False
+        if (length is None) and not chunked:
+            # The body ends when the server closes the connection.
+            connection.keep_alive = False
+        raw = _Body(self, connection, length, chunked)
+        return Response(status_code, response_headers, raw)
+
+
+client = HttpClient()
+
+
+def get(url: str, headers=None) -> Response:
+    return client.get(url, headers=headers)
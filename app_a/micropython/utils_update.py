@@ -0,0 +1,238 @@
+import json
+import time
+import random
+import _thread
+import utils_http
+import config_secrets
+
+import utils_download_package
+
+# May be overwritten in 'config_secrets.py'
+POLL_INTERVAL_MS = getattr(config_secrets, "POLL_INTERVAL_MS", 60000)
+POLL_JITTER_MS = getattr(config_secrets, "POLL_JITTER_MS", 10000)
+POLL_BACKOFF_MAX_MS = getattr(config_secrets, "POLL_BACKOFF_MAX_MS", 30 * 60000)
+# Bigger buffers download faster but need a contiguous block on the heap.
+DOWNLOAD_BUFFER_BYTES = getattr(config_secrets, "DOWNLOAD_BUFFER_BYTES", 1024)
+# The packager publishes 'latest/<branch>' as retained message to this topic:
+# For example "app_packager/app_a/latest/main". None: Poll using http.
+MQTT_TOPIC_LATEST = getattr(config_secrets, "MQTT_TOPIC_LATEST", None)
+PUSH_WAIT_MS = const(1000)
+
+
+class PollScheduler:
+    """
+    Sleeps between update checks.
+    The interval doubles after every failure up to POLL_BACKOFF_MAX_MS.
+    The jitter avoids all devices polling at the same time.
+    """
+
+    def __init__(self):
+        self._interval_ms = POLL_INTERVAL_MS
+
+    def success(self) -> None:
+        self._interval_ms = POLL_INTERVAL_MS
+
+    def failure(self) -> None:
+        self._interval_ms = min(2 * self._interval_ms, POLL_BACKOFF_MAX_MS)
+
+    def sleep(self) -> None:
+        sleep_ms = self._interval_ms + random.randint(0, POLL_JITTER_MS)
+        print(f"Next update check in {sleep_ms}ms")
+        time.sleep_ms(sleep_ms)
+
+
+class LatestSha:
+    """
+    Polls 'latest/<branch>.sha' using a conditional GET:
+    As long as the sha does not change, the server responds '304 Not Modified'.
+    """
+
+    def __init__(self):
+        self._etag = None
+
+    def changed(self, commit_sha_installed) -> bool:
+        """
+        Return True if the published commit differs from 'commit_sha_installed'.
+        """
+        url = config_secrets.URL_APP + config_secrets.BRANCH + ".sha"
+        headers = {}
+        if self._etag is not None:
+            headers["If-None-Match"] = self._etag
+        response = utils_http.get(url, headers=headers)
+        try:
+            if response.status_code == 304:
+                return False
+            if response.status_code == 404:
+                # Published by an older packager
+                return True
+            if response.status_code != 200:
+                raise OSError(f"{url}: status_code={response.status_code}")
+            if response.text.strip() != commit_sha_installed:
+                return True
+            # Only remember the etag if there is nothing to do:
+            # A failed download will be retried.
+            for key, value in response.headers.items():
+                if key.lower() == "etag":
+                    self._etag = value
+            return False
+        finally:
+            response.close()
+
+
+latest_sha = LatestSha()
+
+
+def read_manifest():
+    try:
+        with open("config_package_manifest.json", "r") as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def new_version_available(tar_version="src", latest_package=None):
+    """
+    Return download url if new package is available
+    latest_package: The 'latest/<branch>' document received over mqtt: Nothing is polled.
+    """
+    config_package_manifest = read_manifest()
+    if latest_package is None:
+        if config_package_manifest is not None:
+            if not latest_sha.changed(config_package_manifest["commit_sha"]):
+                print("No new download!")
+                return None
+
+        url = config_secrets.URL_APP + config_secrets.BRANCH
+        response = utils_http.get(url)
+        if response.status_code != 200:
+            response.close()
+            raise OSError(f"{url}: status_code={response.status_code}")
+        latest_package = response.json()
+
+    # Prefer the compressed tars: Less to download.
+    dict_tars = latest_package["dict_tars"]
+    dict_tar = dict_tars.get(tar_version + "/zlib", None) or dict_tars[tar_version]
+
+    if config_package_manifest is None:
+        print("New download: Failed to 'import config_package_manifest'")
+        return dict_tar
+    # print("dict_tar", dict_tar)
+    if latest_package["commit_sha"] == config_package_manifest["commit_sha"]:
+        print("No new download!")
+        return None
+
+    print(f"New download: {latest_package['commit_pretty']}")
+
+    # The delta package only contains the files changed since our commit.
+    dict_tar_delta = dict_tars.get(tar_version + "/delta/zlib", None) or dict_tars.get(
+        tar_version + "/delta", None
+    )
+    # A delta based on the same commit but another version (src/mpy) would
+    # remove all our files: Manifests without 'tar_version' get no delta.
+    if config_package_manifest.get("tar_version", None) != tar_version:
+        dict_tar_delta = None
+    if dict_tar_delta is not None:
+        if dict_tar_delta["base_commit_sha"] == config_package_manifest["commit_sha"]:
+            print(f"New download: delta of {dict_tar_delta['size_bytes']} bytes")
+            return dict_tar_delta
+
+    # Download only the files which differ from the installed ones.
+    dict_tar_files = dict_tars.get(tar_version + "/files", None)
+    if dict_tar_files is not None:
+        if "dict_files" in config_package_manifest:
+            print("New download: changed files")
+            return dict_tar_files
+
+    return dict_tar
+
+
+class Updater:
+    """
+    Checks for a new version, downloads and verifies it into the staging directory.
+    'run()' may be started in a background thread: The application keeps running
+    and calls 'activate()' at a safe point once 'ready' is True.
+    push: Nothing is polled: 'notify()' has to be registered as mqtt callback for MQTT_TOPIC_LATEST.
+    """
+
+    def __init__(self, wlan, tar_version="mpy_version/6.1", push=False):
+        self._wlan = wlan
+        self._tar_version = tar_version
+        self._push = push
+        self._scheduler = PollScheduler()
+        self._names = None
+        self._latest_package = None
+
+    def notify(self, msg: str) -> None:
+        """
+        The mqtt callback: 'msg' is the 'latest/<branch>' document.
+        Runs in the mqtt loop of the application: Must not raise.
+        """
+        try:
+            self._latest_package = json.loads(msg)
+        except ValueError as e:
+            print(f"ERROR: Broken 'latest' document: {e}")
+
+    @property
+    def ready(self) -> bool:
+        """
+        True if a new version is staged.
+        """
+        return self._names is not None
+
+    def poll(self, latest_package=None) -> bool:
+        """
+        Returns True if a new version has been staged.
+        Raises OSError on network errors and ValueError/KeyError on a broken document.
+        """
+        metrics = utils_download_package.metrics
+        metrics.reset()
+        self._wlan.connect()
+        metrics.start("check")
+        dict_tar = new_version_available(self._tar_version, latest_package)
+        metrics.stop()
+        if dict_tar is None:
+            return False
+        names = utils_download_package.prepare_new_version(
+            dict_tar, buffer_bytes=DOWNLOAD_BUFFER_BYTES
+        )
+        if names is None:
+            raise OSError("Download failed")
+        self._names = names
+        return True
+
+    def run(self) -> None:
+        """
+        Polls (or waits for 'notify()') until a new version is staged.
+        """
+        while True:
+            if self._push and (self._latest_package is None):
+                time.sleep_ms(PUSH_WAIT_MS)
+                continue
+            latest_package = self._latest_package
+            self._latest_package = None
+            try:
+                if self.poll(latest_package):
+                    return
+                self._scheduler.success()
+                if self._push:
+                    continue
+            except Exception as e:
+                # Whatever goes wrong: The thread has to keep polling.
+                print(f"ERROR: Update check failed: {e}")
+                utils_download_package.metrics.retries += 1
+                self._scheduler.failure()
+                if self._push and (self._latest_package is None):
+                    # Retry with the same document
+                    self._latest_package = latest_package
+
+            self._scheduler.sleep()
+
+    def start_thread(self) -> None:
+        _thread.start_new_thread(self.run, ())
+
+    def activate(self) -> None:
+        """
+        Moves the staged version into place and resets.
+        """
+        assert self.ready
+        utils_download_package.activate_new_version(self._names)
@@ -1,4 +1,6 @@
 import time
+import _thread
+import binascii
 import rp2
 import network
 
@@ -11,14 +13,51 @@ network.country(country)
 
 
 WLAN_CONNECT_TIME_OUT_MS = const(10000)
+# Reconnecting to the known access point takes some 100ms.
+WLAN_RECONNECT_TIME_OUT_MS = const(3000)
+WLAN_POLL_MS = const(50)
+# The scan results are reused for reconnects within this time.
+WLAN_SCAN_TTL_MS = const(60000)
+# Another access point has to be stronger by this to replace the last good one.
+WLAN_PREFER_LAST_BSSID_DB = const(8)
+# Time between power off and power on
+WLAN_POWER_OFF_MS = const(1000)
+# The wait after a failed attempt doubles up to the maximum.
+WLAN_BACKOFF_MIN_MS = const(1000)
+WLAN_BACKOFF_MAX_MS = const(32000)
 
+# The states of 'WLAN.tick()'
+STATE_IDLE = const(0)
+STATE_SCANNING = const(1)
+STATE_ASSOCIATING = const(2)
+STATE_GOT_IP = const(3)
+STATE_BACKOFF = const(4)
+STATE_NAMES = ("idle", "scanning", "associating", "got-ip", "backoff")
 
 class WLAN:
     def __init__(self):
         self._wdt_feed = lambda: False
+        self._event_cb = lambda duration_ms, ssid_index, rssi, status: None
         self._wlan = network.WLAN(network.STA_IF)
         self._wlan.config(pm=network.WLAN.PM_PERFORMANCE)
         self.connection_counter = 0
+        # (ssid, password, bssid, channel) of the last successful connection
+        self._last_network = None
+        # See 'tick()'
+        self._lock = _thread.allocate_lock()
+        self.state = STATE_IDLE
+        self._state_ms = time.ticks_ms()
+        self._backoff_ms = WLAN_BACKOFF_MIN_MS
+        self._candidate = None
+        self._reconnecting = False
+        self._timeout_ms = 0
+        self._attempt_ms = 0
+        self._scan_results = None
+        self._scan_ms = 0
+        # The bssid of the last successful connection: Preferred by '_find_ssid()'
+        self._good_bssid = None
+        # The selected network and why: Exported as metrics
+        self.selection = None
         # time.sleep(1.0)
         # print(f"DEBUG: reset 2: {self._wlan.isconnected()}, {self._wlan.status()}")
 
@@ -29,6 +68,15 @@ class WLAN:
         """
         self._wdt_feed = wdt_feed_cb
 
+    def register_event_cb(self, event_cb):
+        """
+        'event_cb(duration_ms, ssid_index, rssi, status)' is called at the end
+        of every connection attempt, successful or not.
+        ssid_index: Index into SSID_CREDENTIALS or -1 if no known network was found.
+        status: 'network.STAT_GOT_IP' on success.
+        """
+        self._event_cb = event_cb
+
     def power_on(self) -> None:
         """
         Power of the WLAN interface
@@ -76,28 +124,73 @@ class WLAN:
     def ip_address(self):
         return self._wlan.ifconfig()[0]
 
-    def _find_ssid(self):
+    def _scan(self) -> list:
         """
-        returns (ssid, password)
-        or (None, None)
+        Returns the scan results: They are reused for WLAN_SCAN_TTL_MS.
         """
-        # Scan the wlan
+        if self._scan_results is not None:
+            if time.ticks_diff(time.ticks_ms(), self._scan_ms) < WLAN_SCAN_TTL_MS:
+                return self._scan_results
         self._wdt_feed()
-        set_ssids = {l[0] for l in self._wlan.scan()}
+        results = self._wlan.scan()
+        self._scan_results = results if len(results) > 0 else None
+        self._scan_ms = time.ticks_ms()
+        return results
+
+    def _find_ssid(self):
+        """
+        returns (ssid, password, bssid, channel)
+        or None
 
-        if len(set_ssids) == 0:
+        The known access point with the strongest signal is selected.
+        The last good access point is kept unless another is stronger by WLAN_PREFER_LAST_BSSID_DB.
+        """
+        results = self._scan()
+
+        if len(results) == 0:
             print("WARNING: WLANs.scan() returned empty list!")
-            return (None, None)
+            return None
 
-        for ssid, password in config_secrets.SSID_CREDENTIALS:
+        dict_passwords = {}
+        for index, (ssid, password) in enumerate(config_secrets.SSID_CREDENTIALS):
             assert isinstance(ssid, bytes), ssid
             assert isinstance(password, str), password
-            if ssid in set_ssids:
-                print(f"DEBUG: selected network: {ssid}")
-                return (ssid, password)
+            dict_passwords[ssid] = (index, password)
+
+        strongest = None
+        last_good = None
+        candidates = 0
+        for l in results:
+            # (ssid, bssid, channel, RSSI, security, hidden)
+            if l[0] not in dict_passwords:
+                continue
+            candidates += 1
+            if (strongest is None) or (l[3] > strongest[3]):
+                strongest = l
+            if l[1] == self._good_bssid:
+                last_good = l
+
+        if strongest is None:
+            print("WARNING: WLANs.scan(): No matching network seen!")
+            return None
 
-        print("WARNING: WLANs.scan(): No matching network seen!")
-        return (None, None)
+        selected, reason = strongest, "strongest"
+        if last_good is not None:
+            if last_good[3] + WLAN_PREFER_LAST_BSSID_DB >= strongest[3]:
+                selected, reason = last_good, "last_bssid"
+        ssid, bssid, channel, rssi = selected[:4]
+        index, password = dict_passwords[ssid]
+        self.selection = {
+            "ssid": ssid.decode(),
+            "index": index,
+            "bssid": binascii.hexlify(bssid).decode(),
+            "channel": channel,
+            "rssi": rssi,
+            "reason": reason,
+            "candidates": candidates,
+        }
+        print(f"DEBUG: selected network: {self.selection}")
+        return (ssid, password, bssid, channel)
 
     @property
     def ip_address(self):
@@ -115,42 +208,172 @@ class WLAN:
             return False
         return self.ip_address != "0.0.0.0"
 
-    def connect(self) -> bool:
+    def _switch(self, state: int) -> None:
+        # print(f"DEBUG: WLAN {STATE_NAMES[self.state]} -> {STATE_NAMES[state]}")
+        self.state = state
+        self._state_ms = time.ticks_ms()
+
+    @property
+    def _state_duration_ms(self) -> int:
+        return time.ticks_diff(time.ticks_ms(), self._state_ms)
+
+    def _start_scanning(self) -> None:
         """
-        Return True if connection could be established
+        Power cycle the interface: 'scan()' follows after WLAN_POWER_OFF_MS.
         """
-        try:
-            if self.got_ip_address:
-                return True
-            print(f"DEBUG: connecting WLAN ...")
-            self._wdt_feed()
-            self.power_off()
-            time.sleep(1)
-            self.power_on()
-            ssid, password = self._find_ssid()
-            if ssid is None:
-                # print("WARNING: No known SSID!")
-                return False
+        print(f"DEBUG: connecting WLAN ...")
+        self._attempt_ms = time.ticks_ms()
+        self.power_off()
+        self._switch(STATE_SCANNING)
+
+    def _associate(self, candidate, reconnect: bool) -> None:
+        """
+        reconnect: Connect to the access point of the last connection:
+          No power cycle and no scan.
+        """
+        ssid, password, bssid, channel = candidate
+        self._candidate = candidate
+        self._reconnecting = reconnect
+        if reconnect:
+            print(f"DEBUG: reconnecting WLAN '{ssid:s}' ...")
+            self._attempt_ms = time.ticks_ms()
+            if not self._wlan.active():
+                self.power_on()
+            if self.selection is not None:
+                self.selection["reason"] = "reconnect"
+            self._timeout_ms = WLAN_RECONNECT_TIME_OUT_MS
+        else:
             print(f"DEBUG: connecting WLAN '{ssid:s}' ...")
-            self._wdt_feed()
-            self._wlan.connect(ssid, password)
-            start_ms = time.ticks_ms()
-            while True:
-                self._wdt_feed()
-                duration_ms = time.ticks_diff(time.ticks_ms(), start_ms)
-                if self.got_ip_address:
-                    break
-                if duration_ms > WLAN_CONNECT_TIME_OUT_MS:
-                    print(
-                        f"WARNING: Timeout of {duration_ms}ms while waiting for connection!"
-                    )
-                    return False
-                time.sleep(1)
+            self._timeout_ms = WLAN_CONNECT_TIME_OUT_MS
+        # The bssid selects the access point if several share the ssid
+        self._wlan.connect(ssid, password, bssid=bssid, channel=channel)
+        self._switch(STATE_ASSOCIATING)
+
+    def _event(self, status: int, selection) -> None:
+        """
+        The end of a connection attempt: See 'register_event_cb()'.
+        """
+        ssid_index, rssi = -1, 0
+        if selection is not None:
+            ssid_index, rssi = selection["index"], selection["rssi"]
+        duration_ms = time.ticks_diff(time.ticks_ms(), self._attempt_ms)
+        self._event_cb(duration_ms, ssid_index, rssi, status)
+
+    def _backoff(self) -> None:
+        print(f"DEBUG: WLAN retry in {self._backoff_ms}ms")
+        self._switch(STATE_BACKOFF)
+
+    def _tick_associating(self) -> None:
+        duration_ms = self._state_duration_ms
+        ssid = self._candidate[0]
+        if self.got_ip_address:
             print(
                 f"DEBUG: Connected within {duration_ms}ms to {ssid} and ip {self.ip_address}"
             )
             self.connection_counter += 1
-            return True
+            self._last_network = self._candidate
+            self._good_bssid = self._candidate[2]
+            if self.selection is not None:
+                try:
+                    self.selection["rssi"] = self._wlan.status("rssi")
+                except (ValueError, OSError):
+                    pass
+            self._backoff_ms = WLAN_BACKOFF_MIN_MS
+            self._switch(STATE_GOT_IP)
+            self._event(network.STAT_GOT_IP, self.selection)
+            return
+        status = self._wlan.status()
+        if status < 0:
+            print(f"WARNING: Connection to {ssid} failed: {self.get_status_name(status)}")
+        elif duration_ms > self._timeout_ms:
+            print(f"WARNING: Timeout of {duration_ms}ms while waiting for connection!")
+        else:
+            return
+        self._event(status, self.selection)
+        # The access point is not what the scan told: Scan again next time.
+        self._scan_results = None
+        if self._candidate[2] == self._good_bssid:
+            self._good_bssid = None
+        if self._reconnecting:
+            # The access point might have gone: Do the full procedure.
+            self._last_network = None
+            self._start_scanning()
+            return
+        self._backoff()
+
+    def _tick(self) -> None:
+        if self.state == STATE_GOT_IP:
+            if self.got_ip_address:
+                return
+            print("WARNING: WLAN connection lost!")
+            self._switch(STATE_IDLE)
+
+        if self.state == STATE_IDLE:
+            if self.got_ip_address:
+                self._switch(STATE_GOT_IP)
+            elif self._last_network is not None:
+                self._associate(self._last_network, reconnect=True)
+            else:
+                self._start_scanning()
+            return
+
+        if self.state == STATE_SCANNING:
+            if self._state_duration_ms < WLAN_POWER_OFF_MS:
+                return
+            self.power_on()
+            candidate = self._find_ssid()
+            if candidate is None:
+                # print("WARNING: No known SSID!")
+                self._event(self._wlan.status(), None)
+                self._backoff()
+                return
+            self._associate(candidate, reconnect=False)
+            return
+
+        if self.state == STATE_ASSOCIATING:
+            self._tick_associating()
+            return
+
+        if self.state == STATE_BACKOFF:
+            if self._state_duration_ms < self._backoff_ms:
+                return
+            self._backoff_ms = min(2 * self._backoff_ms, WLAN_BACKOFF_MAX_MS)
+            self._switch(STATE_IDLE)
+
+    def tick(self) -> bool:
+        """
+        Advances the connection by one step and returns True if we have a ip address.
+        Never waits: The control loop calls this on every iteration.
+        Only 'active(True)' and 'scan()' of the driver block: Once per full connection attempt.
+        """
+        if not self._lock.acquire(0):
+            # The other core is connecting
+            return self.state == STATE_GOT_IP
+        try:
+            self._wdt_feed()
+            self._tick()
         except OSError as e:
             print(f"ERROR: wlan.connect() failed: {e}")
-            return False
+            self._last_network = None
+            self._backoff()
+        finally:
+            self._lock.release()
+        return self.state == STATE_GOT_IP
+
+    def connect(self) -> bool:
+        """
+        Return True if connection could be established
+
+        Blocks until connected or the attempt failed. Loops which must not block call 'tick()'.
+        If there was a connection before, we first try to reconnect to the same access point.
+        Only if this fails, the interface is power cycled and the wlan scanned.
+        """
+        if self.state == STATE_BACKOFF:
+            # An explicit connect does not wait
+            self._switch(STATE_IDLE)
+        while True:
+            if self.tick():
+                return True
+            if self.state == STATE_BACKOFF:
+                return False
+            time.sleep_ms(WLAN_POLL_MS)
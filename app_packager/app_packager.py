@@ -1,15 +1,21 @@
 import argparse
-import importlib
+import ast
+import concurrent.futures
+import importlib.util
+import os
 import pathlib
-import tempfile
 import subprocess
 import shutil
+import socket
+import struct
 import hashlib
 import io
 import json
 import tarfile
+import threading
+import zlib
 import html
-from typing import Any, Iterator, List, Protocol, runtime_checkable
+from typing import Any, Dict, Iterator, List, Optional, Protocol, Set, Tuple, runtime_checkable
 
 import git
 import mpy_cross_v6_1
@@ -17,8 +23,25 @@ import mpy_cross_v6_1
 DIRECTORY_OF_THIS_FILE = pathlib.Path(__file__).parent
 DIRECTORY_REPO = DIRECTORY_OF_THIS_FILE.parent
 DIRECTORY_WEB_DOWNOADS = DIRECTORY_REPO / "web_downloads"
+DIRECTORY_MPY_CROSS_CACHE = DIRECTORY_REPO / "mpy_cross_cache"
 
 TAR_SUFFIX = ".tar"
+TAR_DELTA = "/delta"
+TAR_ZLIB = "/zlib"
+TAR_FILES = "/files"
+TAR_ZLIB_SUFFIX = ".zlib"
+# The device needs a buffer of 2**TAR_ZLIB_WBITS bytes to decompress.
+TAR_ZLIB_WBITS = 10
+# The device verifies every chunk and may resume the download after the last good chunk.
+TAR_CHUNK_SIZE = 4096
+TAR_CHUNKS_SUFFIX = ".chunks"
+FILENAME_MANIFEST = "config_package_manifest.json"
+# 'latest/<branch>.sha' only contains the commit sha: Cheap to poll for the device.
+LATEST_SHA_SUFFIX = ".sha"
+MPY_SUFFIX = ".mpy"
+MQTT_PORT = 1883
+MQTT_TOPIC_PREFIX = "app_packager"
+MPY_CROSS_FLAGS: List[str] = []
 FILENAME_APP_PACKAGE_PY = "app_package.py"
 
 
@@ -27,28 +50,78 @@ class AppPackage(Protocol):
     name: str
     directory: pathlib.Path
     globs: List[str]
+    # Optional 'entry_points: List[str]', for example ["main.py"]:
+    # Only the python modules imported from there will be packaged.
 
 
 class GitBranch:
-    def __init__(self, branch: str, head: git.HEAD):
+    def __init__(self, branch: str, commit: git.Commit, worktree: bool):
+        """
+        worktree: True if the files are read from the working tree.
+          False if the files are read from the git objects of 'commit'.
+        """
         assert isinstance(branch, str)
-        assert isinstance(head, git.HEAD)
+        assert isinstance(commit, git.Commit)
+        assert isinstance(worktree, bool)
         self.name = branch
-        self.head = head
+        # Remember the commit: HEAD will move on when the next branch is checked out.
+        self.commit = commit
+        self.worktree = worktree
 
     @property
     def sha(self) -> str:
-        return self.head.commit.hexsha
+        return self.commit.hexsha
 
     @property
     def commit_pretty(self) -> str:
-        commit = self.head.commit
+        commit = self.commit
         return f"{commit.author.name} <{commit.author.email}>: {commit.summary}"
 
     @property
     def pretty(self) -> str:
         return f"{self.name} - {self.commit_pretty}"
 
+    def iter_files(
+        self, app_package: AppPackage
+    ) -> Iterator[Tuple[pathlib.PurePosixPath, bytes]]:
+        """
+        Yields (path relative to 'app_package.directory', content)
+        for all files matching 'app_package.globs'.
+        """
+        if self.worktree:
+            for glob in app_package.globs:
+                # Sorted like the git objects below: Both yield the same tar.
+                relatives = sorted(
+                    file.relative_to(app_package.directory).as_posix()
+                    for file in app_package.directory.rglob(glob)
+                    if file.is_file()
+                )
+                for relative in relatives:
+                    data = (app_package.directory / relative).read_bytes()
+                    yield pathlib.PurePosixPath(relative), data
+            return
+
+        directory = (
+            app_package.directory.resolve()
+            .relative_to(DIRECTORY_REPO.resolve())
+            .as_posix()
+        )
+        try:
+            tree = self.commit.tree / directory
+        except KeyError:
+            # The directory does not exist in this commit: Same as 'rglob()'.
+            return
+        blobs = sorted(
+            (item for item in tree.traverse() if item.type == "blob"),
+            key=lambda blob: blob.path,
+        )
+        for glob in app_package.globs:
+            for blob in blobs:
+                relative = pathlib.PurePosixPath(blob.path).relative_to(directory)
+                # Same semantics as 'rglob()': The pattern is matched from the right.
+                if relative.match(glob):
+                    yield relative, blob.data_stream.read()
+
 
 class Git:
     def __init__(self):
@@ -71,17 +144,67 @@ class Git:
                 return ref
         raise Exception(f"Not found: remote_head '{remote_head}'")
 
+    def branch(self, remote_head: str, no_checkout: bool) -> GitBranch:
+        """
+        Returns the branch without checking it out.
+        """
+        assert isinstance(remote_head, str)
+        assert isinstance(no_checkout, bool)
+
+        if no_checkout:
+            return GitBranch(
+                branch=remote_head, commit=self._repo.head.commit, worktree=True
+            )
+
+        ref = self._get_ref(remote_head=remote_head)
+        return GitBranch(branch=remote_head, commit=ref.commit, worktree=False)
+
+    def base_branch(
+        self, branch: GitBranch, dict_latest: Optional[dict]
+    ) -> Optional[GitBranch]:
+        """
+        Returns the commit the delta tars of 'branch' are based on, read from the git objects:
+        The commit published by the last run ('dict_latest') or, without a last run,
+        the parent commit. The deploy workflow always starts without a last run.
+        Returns None if there is no such commit.
+        """
+        assert isinstance(branch, GitBranch)
+        assert isinstance(dict_latest, (dict, type(None)))
+
+        if dict_latest is not None:
+            try:
+                commit = self._repo.commit(dict_latest["commit_sha"])
+            except (ValueError, git.BadName):
+                # For example after a force push
+                return None
+        else:
+            if not branch.commit.parents:
+                return None
+            commit = branch.commit.parents[0]
+        if commit.hexsha == branch.sha:
+            return None
+        return GitBranch(branch=branch.name, commit=commit, worktree=False)
+
     def checkout(self, remote_head: str, no_checkout: bool) -> GitBranch:
         assert isinstance(remote_head, str)
         assert isinstance(no_checkout, bool)
 
         if no_checkout:
-            return GitBranch(branch=remote_head, head=self._repo.head)
+            return self.branch(remote_head=remote_head, no_checkout=no_checkout)
 
         ref = self._get_ref(remote_head=remote_head)
         head = ref.checkout()
         assert isinstance(head, git.HEAD)
-        return GitBranch(branch=remote_head, head=head)
+        return GitBranch(branch=remote_head, commit=head.commit, worktree=True)
+
+
+def iter_links(dict_tar: dict) -> Iterator[str]:
+    """
+    Yields the links of the files published for 'dict_tar'.
+    """
+    yield dict_tar["link"]
+    if "link_chunks" in dict_tar:
+        yield dict_tar["link_chunks"]
 
 
 class IndexHtml:
@@ -130,12 +253,80 @@ class IndexHtml:
         self.add_href(link=directory, label=title)
         return IndexHtml(directory=directory, title=title, verbose=self._verbose)
 
-    def add_branch(self, branch: GitBranch, dict_tars: dict) -> None:
+    def _latest(self, branch: GitBranch) -> pathlib.Path:
+        return self.directory / "latest" / branch.name
+
+    def read_latest(self, branch: GitBranch) -> Optional[dict]:
+        """
+        Returns the 'latest/<branch>' document of the last run.
+        """
+        assert isinstance(branch, GitBranch)
+        latest = self._latest(branch=branch)
+        try:
+            return json.loads(latest.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def get_unchanged_tars(self, branch: GitBranch) -> Optional[dict]:
+        """
+        Returns 'dict_tars' of the last run if 'branch' did not move
+        and all tars are still available.
+        Returns None if the tars have to be rebuilt.
+        """
+        assert isinstance(branch, GitBranch)
+        dict_json = self.read_latest(branch=branch)
+        if dict_json is None:
+            return None
+        if dict_json.get("commit_sha", None) != branch.sha:
+            return None
+        dict_tars = dict_json.get("dict_tars", {})
+        versions = {
+            cls_tar.version + compression
+            for cls_tar in TAR_CLASSES
+            for compression in ("", TAR_ZLIB, TAR_FILES)
+        }
+        if not versions <= set(dict_tars):
+            return None
+        for dict_tar in dict_tars.values():
+            for link in iter_links(dict_tar):
+                if not (self.directory / link).is_file():
+                    return None
+        return dict_tars
+
+    def get_file_links(self, dict_tar: dict) -> Set[str]:
+        """
+        Returns the links of all files listed in the manifest 'dict_tar'.
+        """
+        assert isinstance(dict_tar, dict)
+        dict_manifest = json.loads((self.directory / dict_tar["link"]).read_text())
+        return {
+            dict_tar["link_files"] + dict_file["sha256"]
+            for dict_file in dict_manifest["dict_files"].values()
+        }
+
+    def remove_unreferenced(self, references: Set[str]) -> None:
+        """
+        Removes all files of previous runs which are not in 'references'.
+        """
+        assert isinstance(references, set)
+        for file in sorted(self.directory.rglob("*")):
+            if not file.is_file() or file == self.filename:
+                continue
+            if file.relative_to(self.directory).as_posix() in references:
+                continue
+            if self._verbose:
+                print(f"  remove obsolete {file}")
+            file.unlink()
+
+    def add_branch(self, branch: GitBranch, dict_tars: dict) -> Set[str]:
+        """
+        Writes 'latest/<branch>' and returns the links written.
+        """
         assert isinstance(branch, GitBranch)
         assert isinstance(dict_tars, dict)
         if self._verbose:
             print(f"  branch={branch.name} sha={branch.sha}")
-        latest = self.directory / "latest" / branch.name
+        latest = self._latest(branch=branch)
         latest.parent.mkdir(parents=True, exist_ok=True)
         dict_json = dict(
             commit_sha=branch.sha,
@@ -143,8 +334,326 @@ class IndexHtml:
             dict_tars=dict_tars,
         )
         latest.write_text(json.dumps(dict_json, indent=4))
+        latest_sha = latest.with_name(latest.name + LATEST_SHA_SUFFIX)
+        latest_sha.write_text(branch.sha)
         self.add_index(link=latest, tag="h2")
         self.add_italic(branch.commit_pretty)
+        return {
+            file.relative_to(self.directory).as_posix() for file in (latest, latest_sha)
+        }
+
+
+class MqttPublisher:
+    """
+    Publishes retained messages to a MQTT broker.
+    A minimal MQTT 3.1.1 client (QoS 1): The packager does not need a mqtt library.
+    The credentials are read from the environment: APP_PACKAGER_MQTT_USER, APP_PACKAGER_MQTT_PASSWORD.
+    """
+
+    def __init__(self, broker: str, verbose: bool):
+        assert isinstance(broker, str)
+        assert isinstance(verbose, bool)
+        self._verbose = verbose
+        host, _, port = broker.partition(":")
+        self._sock = socket.create_connection((host, int(port or MQTT_PORT)), timeout=10)
+        self._packet_id = 0
+
+        user = os.environ.get("APP_PACKAGER_MQTT_USER", None)
+        password = os.environ.get("APP_PACKAGER_MQTT_PASSWORD", None)
+        flags = 0x02  # Clean session
+        payload = self._string(f"app_packager_{os.getpid()}")
+        if user is not None:
+            flags |= 0x80
+            payload += self._string(user)
+            # MQTT 3.1.1: A password without a user is a protocol violation.
+            if password is not None:
+                flags |= 0x40
+                payload += self._string(password)
+        variable_header = self._string("MQTT") + struct.pack("!BBH", 4, flags, 60)
+        self._send(0x10, variable_header + payload)
+        packet_type, data = self._receive()
+        if packet_type != 0x20 or data[1] != 0:
+            raise ConnectionError(f"mqtt {broker}: connect refused: {data!r}")
+
+    def __enter__(self) -> "MqttPublisher":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._send(0xE0, b"")
+        self._sock.close()
+
+    @staticmethod
+    def _string(text: str) -> bytes:
+        data = text.encode("utf-8")
+        return struct.pack("!H", len(data)) + data
+
+    def _send(self, header: int, data: bytes) -> None:
+        remaining_length = bytearray()
+        size = len(data)
+        while True:
+            size, digit = divmod(size, 128)
+            remaining_length.append(digit | (0x80 if size else 0))
+            if not size:
+                break
+        self._sock.sendall(bytes([header]) + remaining_length + data)
+
+    def _receive_exactly(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("mqtt: connection closed")
+            data += chunk
+        return data
+
+    def _receive(self) -> Tuple[int, bytes]:
+        header = self._receive_exactly(1)[0]
+        size, shift = 0, 0
+        while True:
+            digit = self._receive_exactly(1)[0]
+            size |= (digit & 0x7F) << shift
+            shift += 7
+            if not digit & 0x80:
+                break
+        return header & 0xF0, self._receive_exactly(size)
+
+    def publish_retained(self, topic: str, payload: bytes) -> None:
+        """
+        Returns when the broker acknowledged the message.
+        """
+        self._packet_id = self._packet_id % 0xFFFF + 1
+        if self._verbose:
+            print(f"  mqtt: {topic} ({len(payload)} bytes)")
+        data = self._string(topic) + struct.pack("!H", self._packet_id) + payload
+        self._send(0x33, data)  # PUBLISH, QoS 1, retain
+        packet_type, data = self._receive()
+        if packet_type != 0x40 or struct.unpack("!H", data[:2])[0] != self._packet_id:
+            raise ConnectionError(f"mqtt {topic}: no puback: {data!r}")
+
+
+class MpyCross:
+    """
+    Runs 'mpy-cross' for many files concurrently.
+    Every compilation is a subprocess of its own: The threads just wait
+    for the subprocesses which allows to use all cores.
+
+    The compiled files are cached in DIRECTORY_MPY_CROSS_CACHE.
+    The cache key is built from the source, the filename, the version of
+    mpy-cross and MPY_CROSS_FLAGS.
+    """
+
+    def __init__(self, verbose: bool):
+        assert isinstance(verbose, bool)
+        self._verbose = verbose
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()
+        )
+        self._version = self._run(
+            [mpy_cross_v6_1.MPY_CROSS_PATH, "--version"]
+        ).decode()
+        # Files compiled in this run: Identical files are compiled only once.
+        self._futures: Dict[pathlib.Path, concurrent.futures.Future] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._executor.shutdown(wait=True)
+        if self._verbose:
+            print(
+                f"mpy-cross cache: {self.cache_hits} hits, {self.cache_misses} misses"
+            )
+
+    def submit(self, source: bytes, filename: str) -> concurrent.futures.Future:
+        """
+        Start the compilation of 'source'.
+        'filename' is embedded into the compiled bytecode.
+        """
+        assert isinstance(source, bytes)
+        assert isinstance(filename, str)
+
+        cache_filename = self._cache_filename(source=source, filename=filename)
+        future = self._futures.get(cache_filename, None)
+        if future is not None:
+            self.cache_hits += 1
+            return future
+
+        if cache_filename.exists():
+            self.cache_hits += 1
+            future = _future_done(cache_filename.read_bytes())
+        else:
+            self.cache_misses += 1
+            future = self._executor.submit(
+                self._compile, source, filename, cache_filename
+            )
+        self._futures[cache_filename] = future
+        return future
+
+    def _cache_filename(self, source: bytes, filename: str) -> pathlib.Path:
+        key = hashlib.sha256()
+        for value in (self._version, *MPY_CROSS_FLAGS, filename):
+            key.update(value.encode())
+            key.update(b"\0")
+        key.update(hashlib.sha256(source).digest())
+        hexdigest = key.hexdigest()
+        return DIRECTORY_MPY_CROSS_CACHE / hexdigest[:2] / (hexdigest + MPY_SUFFIX)
+
+    def _compile(
+        self, source: bytes, filename: str, cache_filename: pathlib.Path
+    ) -> bytes:
+        args = [mpy_cross_v6_1.MPY_CROSS_PATH, *MPY_CROSS_FLAGS, "-s", filename, "-"]
+        data = self._run(args, source=source)
+
+        # Write to a temporary file first: An interrupted run must not leave a truncated file in the cache.
+        cache_filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp_filename = cache_filename.with_name(
+            f"{cache_filename.name}.{threading.get_ident()}.tmp"
+        )
+        tmp_filename.write_bytes(data)
+        tmp_filename.replace(cache_filename)
+        return data
+
+    def _run(self, args: List[str], source: bytes = b"") -> bytes:
+        proc = subprocess.run(args, input=source, capture_output=True)
+        if proc.returncode:
+            print(f"ERROR: {args}")
+            print(f"  stderr={proc.stderr}")
+            raise Exception(f"Error: {args}")
+        if self._verbose:
+            print(f"  mpy-cross returned: {proc.stderr.decode().strip()}")
+        return proc.stdout
+
+
+def _future_done(data: bytes) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    future.set_result(data)
+    return future
+
+
+def _module_names(relative: pathlib.PurePosixPath) -> List[str]:
+    """
+    Returns the names 'relative' may be imported as.
+    micropython also searches 'lib': 'lib/a.py' may be imported as 'a'.
+    """
+    parts = relative.with_suffix("").parts
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    names = [".".join(parts)]
+    if parts[0] == "lib" and len(parts) > 1:
+        names.append(".".join(parts[1:]))
+    return names
+
+
+def _iter_parents(module: str) -> Iterator[str]:
+    """
+    'a.b.c' yields 'a', 'a.b', 'a.b.c': Importing a module imports its packages.
+    """
+    parts = module.split(".")
+    for i in range(1, len(parts) + 1):
+        yield ".".join(parts[:i])
+
+
+def _iter_imports(relative: pathlib.PurePosixPath, tree: ast.AST) -> Iterator[str]:
+    """
+    Yields all module names which may be imported by 'tree'.
+    Imports within functions and 'try' blocks are included.
+    """
+    package = _module_names(relative)[0].split(".")
+    if relative.stem != "__init__":
+        package = package[:-1]
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield from _iter_parents(alias.name)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level == 0:
+                base = node.module
+            else:
+                parts = package[: len(package) - (node.level - 1)]
+                if node.module is not None:
+                    parts.append(node.module)
+                base = ".".join(parts)
+            if base:
+                yield from _iter_parents(base)
+            for alias in node.names:
+                # 'from a import b' may import the module 'a.b'
+                yield f"{base}.{alias.name}" if base else alias.name
+        elif isinstance(node, ast.Call):
+            # __import__("a") and importlib.import_module("a")
+            func = node.func
+            name = func.id if isinstance(func, ast.Name) else getattr(func, "attr", None)
+            if name in ("__import__", "import_module") and node.args:
+                arg = node.args[0]
+                if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                    yield from _iter_parents(arg.value)
+
+
+def prune_unreachable(
+    app_package: AppPackage,
+    files: List[Tuple[pathlib.PurePosixPath, bytes]],
+    verbose: bool,
+) -> List[Tuple[pathlib.PurePosixPath, bytes]]:
+    """
+    Returns 'files' without the python modules which are not imported,
+    directly or indirectly, from 'app_package.entry_points'.
+    Files which are not python modules are always returned.
+    Without 'entry_points', if an entry point is missing (the 'entry_points' of the
+    worktree are applied to all branches) or if a reachable module fails to parse,
+    all files are returned.
+    """
+    entry_points = getattr(app_package, "entry_points", None)
+    if entry_points is None:
+        return files
+
+    sources = dict(files)
+    for entry_point in entry_points:
+        if pathlib.PurePosixPath(entry_point) not in sources:
+            print(
+                f"WARNING: {app_package.name}: entry point {entry_point} not found: Nothing is dropped"
+            )
+            return files
+    modules: Dict[str, pathlib.PurePosixPath] = {}
+    for relative, _ in files:
+        if relative.suffix == ".py":
+            for name in _module_names(relative):
+                modules.setdefault(name, relative)
+
+    reachable: Set[pathlib.PurePosixPath] = set()
+    todo = [pathlib.PurePosixPath(entry_point) for entry_point in entry_points]
+    while todo:
+        relative = todo.pop()
+        if relative in reachable:
+            continue
+        reachable.add(relative)
+        try:
+            tree = ast.parse(sources[relative], filename=str(relative))
+        except SyntaxError as e:
+            print(f"WARNING: {app_package.name}: {e}: Unknown imports, nothing is dropped")
+            return files
+        for module in _iter_imports(relative=relative, tree=tree):
+            imported = modules.get(module, None)
+            if imported is not None:
+                todo.append(imported)
+
+    dropped = [
+        (relative, data)
+        for relative, data in files
+        if relative.suffix == ".py" and relative not in reachable
+    ]
+    if verbose:
+        bytes_saved = sum(len(data) for _, data in dropped)
+        print(
+            f"  {app_package.name}: dropped {len(dropped)} unreachable modules, {bytes_saved} bytes saved"
+        )
+        for relative, data in dropped:
+            print(f"    {relative} ({len(data)} bytes)")
+    return [
+        (relative, data)
+        for relative, data in files
+        if relative.suffix != ".py" or relative in reachable
+    ]
 
 
 class TarSrc:
@@ -152,98 +661,233 @@ class TarSrc:
         self,
         branch: GitBranch,
         app_package: AppPackage,
+        files: List[Tuple[pathlib.PurePosixPath, bytes]],
+        mpy_cross: MpyCross,
         verbose: bool,
     ):
+        """
+        'files' are the files of the package, see 'GitBranch.iter_files()'.
+        The tar file will be written by 'write()'.
+        """
         assert isinstance(branch, GitBranch)
         assert isinstance(app_package, AppPackage)
+        assert isinstance(files, list)
+        assert isinstance(mpy_cross, MpyCross)
         assert isinstance(verbose, bool)
 
         self._verbose = verbose
-        link = self.version + "/" + (branch.sha + TAR_SUFFIX)
-        self.tar_filename = DIRECTORY_WEB_DOWNOADS / app_package.name / link
-
-        self.tar_filename.parent.mkdir(parents=True, exist_ok=True)
-        with self.tar_filename.open("wb") as f:
-            files: List[str] = []
-            with tarfile.open(name="app.tar", mode="w", fileobj=f) as tar:
-
-                def add_file(name: str, data: bytes):
-                    assert isinstance(name, str)
-                    assert isinstance(data, bytes)
-
-                    tarinfo = tarfile.TarInfo(name=name)
-                    tarinfo.size = len(data)
-                    tar.addfile(tarinfo, io.BytesIO(data))
-
-                for glob in app_package.globs:
-                    for file in app_package.directory.rglob(glob):
-                        name = str(
-                            file.with_suffix(self.py_suffix).relative_to(
-                                app_package.directory
-                            )
-                        )
-                        files.append(name)
-                        if verbose:
-                            print(f"    TarSrc: {name=}")
-                        add_file(name, self._get_bytes(file))
-
-                dict_manifest = dict(
-                    files=files,
-                    branch=branch.name,
-                    commit_sha=branch.sha,
-                    commit_pretty=branch.commit_pretty,
-                )
-                add_file(
-                    "config_package_manifest.json",
-                    json.dumps(dict_manifest, indent=4).encode(),
+        self._branch = branch
+        self._mpy_cross = mpy_cross
+        self._directory = DIRECTORY_WEB_DOWNOADS / app_package.name
+        self.link = self.version + "/" + (branch.sha + TAR_SUFFIX)
+        self.tar_filename = self._directory / self.link
+
+        # The files in the order they will be written into the tar.
+        self._files: List[Tuple[str, concurrent.futures.Future]] = []
+        for relative, data in files:
+            name = str(
+                relative.with_suffix(self.py_suffix)
+                if relative.suffix == ".py"
+                else relative
+            )
+            self._files.append((name, self._get_bytes(relative=relative, data=data)))
+
+    @property
+    def files(self) -> List[Tuple[str, bytes]]:
+        """
+        Waits for all files: (name in the tar, content).
+        """
+        return [(name, future.result()) for name, future in self._files]
+
+    def write(self) -> Dict[str, dict]:
+        """
+        Waits for all files and writes the tar file.
+        Returns the entries for 'dict_tars'.
+        """
+        files = self.files
+        dict_tar, dict_tar_zlib = self._write_tar(
+            link=self.link, files=files, all_files=files, dict_manifest_extra={}
+        )
+        dict_tar_files = self._write_files(files=files)
+        return {
+            self.version: dict_tar,
+            self.version + TAR_ZLIB: dict_tar_zlib,
+            self.version + TAR_FILES: dict_tar_files,
+        }
+
+    def _write_files(self, files: List[Tuple[str, bytes]]) -> dict:
+        """
+        Writes every file as '<version>/files/<sha256>' and the manifest.
+        This allows the device to download only the files which changed.
+        Returns the 'dict_tar' of the manifest.
+        """
+        link_files = f"{self.version}{TAR_FILES}/"
+        for _, data in files:
+            link = link_files + hashlib.sha256(data).hexdigest()
+            if not (self._directory / link).is_file():
+                self._write_file(link=link, data=data)
+
+        dict_manifest = self._manifest(all_files=files, dict_manifest_extra={})
+        dict_tar = self._write_file(
+            link=f"{self.version}/manifest/{self._branch.sha}.json",
+            data=json.dumps(dict_manifest, indent=4).encode(),
+        )
+        dict_tar.update(link_files=link_files)
+        return dict_tar
+
+    def _manifest(
+        self, all_files: List[Tuple[str, bytes]], dict_manifest_extra: dict
+    ) -> dict:
+        return dict(
+            files=[name for name, _ in all_files],
+            dict_files={
+                name: dict(
+                    sha256=hashlib.sha256(data).hexdigest(),
+                    size_bytes=len(data),
                 )
+                for name, data in all_files
+            },
+            branch=self._branch.name,
+            # The device only accepts a delta for the same version.
+            tar_version=self.version,
+            commit_sha=self._branch.sha,
+            commit_pretty=self._branch.commit_pretty,
+            **dict_manifest_extra,
+        )
+
+    def write_delta(self, tar_base: "TarSrc") -> Dict[str, dict]:
+        """
+        Writes a tar with the files changed since 'tar_base': The same version of the base commit.
+        Returns the entries for 'dict_tars'.
+        """
+        assert isinstance(tar_base, type(self))
+
+        base_commit_sha = tar_base._branch.sha
+        files_base = dict(tar_base.files)
+        all_files = self.files
+        files = [
+            (name, data)
+            for name, data in all_files
+            if files_base.get(name, None) != data
+        ]
+        deleted = sorted(set(files_base) - {name for name, _ in all_files})
+        link = f"{self.version}{TAR_DELTA}/{base_commit_sha}_{self._branch.sha}"
+        link += TAR_SUFFIX
+        dict_delta = dict(base_commit_sha=base_commit_sha, deleted=deleted)
+        dict_tar, dict_tar_zlib = self._write_tar(
+            link=link, files=files, all_files=all_files, dict_manifest_extra=dict_delta
+        )
+        dict_tar.update(dict_delta)
+        dict_tar_zlib.update(dict_delta)
+        version = self.version + TAR_DELTA
+        return {version: dict_tar, version + TAR_ZLIB: dict_tar_zlib}
+
+    def _write_tar(
+        self,
+        link: str,
+        files: List[Tuple[str, bytes]],
+        all_files: List[Tuple[str, bytes]],
+        dict_manifest_extra: dict,
+    ) -> Tuple[dict, dict]:
+        """
+        Writes 'files' and the manifest into a tar and a zlib compressed tar.
+        Returns the 'dict_tar' for both.
+        The manifest always lists 'all_files': The device removes all files not listed.
+        """
+        f = io.BytesIO()
+        with tarfile.open(name="app.tar", mode="w", fileobj=f) as tar:
+
+            def add_file(name: str, data: bytes):
+                assert isinstance(name, str)
+                assert isinstance(data, bytes)
+
+                tarinfo = tarfile.TarInfo(name=name)
+                tarinfo.size = len(data)
+                tar.addfile(tarinfo, io.BytesIO(data))
+
+            for name, data in files:
+                if self._verbose:
+                    print(f"    {self.__class__.__name__}: {name=}")
+                add_file(name, data)
+
+            dict_manifest = self._manifest(
+                all_files=all_files, dict_manifest_extra=dict_manifest_extra
+            )
+            add_file(
+                FILENAME_MANIFEST,
+                json.dumps(dict_manifest, indent=4).encode(),
+            )
+
+        # Strip the padding to a full record (10240 bytes): The tar ends after the two empty blocks.
+        # This keeps small delta tars small.
+        data = f.getvalue()[: tar.offset]
+        dict_tar = self._write_file(link=link, data=data)
+        self._write_chunks(dict_tar=dict_tar, data=data)
 
-        data = self.tar_filename.read_bytes()
-        self.dict_tar = dict(
+        # A small window: The device decompresses while extracting.
+        compressobj = zlib.compressobj(
+            level=zlib.Z_BEST_COMPRESSION, method=zlib.DEFLATED, wbits=TAR_ZLIB_WBITS
+        )
+        data_zlib = compressobj.compress(data) + compressobj.flush()
+        dict_tar_zlib = self._write_file(link=link + TAR_ZLIB_SUFFIX, data=data_zlib)
+        dict_tar_zlib.update(compression="zlib", wbits=TAR_ZLIB_WBITS)
+        self._write_chunks(dict_tar=dict_tar_zlib, data=data_zlib)
+        return dict_tar, dict_tar_zlib
+
+    def _write_chunks(self, dict_tar: dict, data: bytes) -> None:
+        """
+        Writes the sha256 of every chunk of TAR_CHUNK_SIZE bytes: One line per chunk.
+        """
+        link_chunks = dict_tar["link"] + TAR_CHUNKS_SUFFIX
+        lines = [
+            hashlib.sha256(data[i : i + TAR_CHUNK_SIZE]).hexdigest() + "\n"
+            for i in range(0, len(data), TAR_CHUNK_SIZE)
+        ]
+        self._write_file(link=link_chunks, data="".join(lines).encode())
+        dict_tar.update(chunk_size=TAR_CHUNK_SIZE, link_chunks=link_chunks)
+
+    def _write_file(self, link: str, data: bytes) -> dict:
+        tar_filename = self._directory / link
+        tar_filename.parent.mkdir(parents=True, exist_ok=True)
+        tar_filename.write_bytes(data)
+        return dict(
             link=link,
             sha256=hashlib.sha256(data).hexdigest(),
             size_bytes=len(data),
         )
 
-    def _get_bytes(self, file: pathlib.Path) -> bytes:
-        return file.read_bytes()
+    def _get_bytes(
+        self, relative: pathlib.PurePosixPath, data: bytes
+    ) -> concurrent.futures.Future:
+        return _future_done(data)
 
-    @property
-    def version(self) -> str:
-        return "src"
-
-    @property
-    def py_suffix(self) -> str:
-        return ".py"
+    version = "src"
+    py_suffix = ".py"
 
 
 class TarMpyCross(TarSrc):
-    @property
-    def version(self) -> str:
-        return "mpy_version/6.1"
+    version = "mpy_version/6.1"
+    py_suffix = MPY_SUFFIX
+
+    def _get_bytes(
+        self, relative: pathlib.PurePosixPath, data: bytes
+    ) -> concurrent.futures.Future:
+        assert isinstance(relative, pathlib.PurePosixPath)
+        assert isinstance(data, bytes)
+        if relative.suffix != ".py":
+            # For example 'config.txt'
+            return _future_done(data)
+        # Only the relative filename is embedded: Identical files in different
+        # directories or branches share the same cache entry.
+        return self._mpy_cross.submit(source=data, filename=str(relative))
 
-    @property
-    def py_suffix(self) -> str:
-        return ".mpy"
-
-    def _get_bytes(self, file: pathlib.Path) -> bytes:
-        assert isinstance(file, pathlib.Path)
-        with tempfile.NamedTemporaryFile() as tmp_file:
-            args = [mpy_cross_v6_1.MPY_CROSS_PATH, "-o", tmp_file.name, str(file)]
-            proc = subprocess.run(args, capture_output=True)
-            if proc.returncode:
-                print(f"ERROR: {args}")
-                print(f"  stdout={proc.stdout}")
-                print(f"  stderr={proc.stderr}")
-                raise Exception(f"Error: {args}")
-            if self._verbose:
-                print(
-                    f"  mpy-cross returned: {proc.stdout.decode().strip()} / {proc.stderr.decode().strip()}"
-                )
-            return pathlib.Path(tmp_file.name).read_bytes()
+
+TAR_CLASSES = (TarSrc, TarMpyCross)
 
 
 def iter_package_py(parent_directory: pathlib.Path) -> Iterator[AppPackage]:
+    # 'web_downloads/<name>' belongs to one app: 'remove_unreferenced()' removes the files of others.
+    filenames: Dict[str, pathlib.Path] = {}
     for filename in parent_directory.glob(f"**/{FILENAME_APP_PACKAGE_PY}"):
         spec = importlib.util.spec_from_file_location("app_package", filename)
         app_package = importlib.util.module_from_spec(spec)
@@ -252,24 +896,39 @@ def iter_package_py(parent_directory: pathlib.Path) -> Iterator[AppPackage]:
         assert isinstance(app_package.name, str)
         assert isinstance(app_package.directory, pathlib.Path)
         assert isinstance(app_package.globs, list)
+        assert (
+            app_package.name not in filenames
+        ), f"{filename}: name '{app_package.name}' is already used by {filenames[app_package.name]}"
+        filenames[app_package.name] = filename
 
         yield app_package
 
 
 def main(
-    parent_directory: pathlib.Path,  verbose: bool, no_checkout: bool
+    parent_directory: pathlib.Path,
+    verbose: bool,
+    no_checkout: bool,
+    incremental: bool,
+    git_objects: bool,
+    mqtt_broker: Optional[str] = None,
+    mqtt_topic_prefix: str = MQTT_TOPIC_PREFIX,
 ) -> None:
     assert isinstance(parent_directory, pathlib.Path)
     assert isinstance(verbose, bool)
     assert isinstance(no_checkout, bool)
+    assert isinstance(incremental, bool)
+    assert isinstance(git_objects, bool)
+    assert isinstance(mqtt_broker, (str, type(None)))
+    assert isinstance(mqtt_topic_prefix, str)
 
-    shutil.rmtree(DIRECTORY_WEB_DOWNOADS, ignore_errors=True)
-    DIRECTORY_WEB_DOWNOADS.mkdir()
+    if not incremental:
+        shutil.rmtree(DIRECTORY_WEB_DOWNOADS, ignore_errors=True)
+    DIRECTORY_WEB_DOWNOADS.mkdir(exist_ok=True)
     git = Git()
 
     with IndexHtml(
         directory=DIRECTORY_WEB_DOWNOADS, title="Downloads", verbose=verbose
-    ) as index_top:
+    ) as index_top, MpyCross(verbose=verbose) as mpy_cross:
         for app_package in iter_package_py(parent_directory=parent_directory):
 
             if verbose:
@@ -278,20 +937,97 @@ def main(
                 relative=app_package.name,
                 title=f"Application: {app_package.name}",
             ) as index_app:
-                for branch in git.remote_heads:
-                    branch = git.checkout(remote_head=branch, no_checkout=no_checkout)
+                # Collect the files of all branches: mpy-cross will compile them concurrently.
+                # 'dict_tars' is not None if the tars of the last run may be reused.
+                # 'tars_base' are the tars of the base commit of the delta tars.
+                branch_tars: List[
+                    Tuple[GitBranch, List[TarSrc], Optional[dict], List[TarSrc]]
+                ] = []
+                for remote_head in git.remote_heads:
+                    branch = git.branch(remote_head=remote_head, no_checkout=no_checkout)
+                    if incremental:
+                        dict_tars = index_app.get_unchanged_tars(branch=branch)
+                        if dict_tars is not None:
+                            if verbose:
+                                print(f"  branch={branch.name} unchanged")
+                            branch_tars.append((branch, [], dict_tars, []))
+                            continue
 
-                    dict_tars = {}
-                    for cls_tar in (TarSrc, TarMpyCross):
-                        tar = cls_tar(
+                    base_branch = git.base_branch(
+                        branch=branch, dict_latest=index_app.read_latest(branch=branch)
+                    )
+                    if not git_objects:
+                        branch = git.checkout(
+                            remote_head=remote_head, no_checkout=no_checkout
+                        )
+                    files = prune_unreachable(
+                        app_package=app_package,
+                        files=list(branch.iter_files(app_package=app_package)),
+                        verbose=verbose,
+                    )
+                    tars = [
+                        cls_tar(
                             branch=branch,
                             app_package=app_package,
+                            files=files,
+                            mpy_cross=mpy_cross,
                             verbose=verbose,
                         )
-                        index_app.add_index(link=tar.tar_filename, tag="p")
-                        dict_tars[tar.version] = tar.dict_tar
+                        for cls_tar in TAR_CLASSES
+                    ]
+                    tars_base = []
+                    if base_branch is not None:
+                        files_base = prune_unreachable(
+                            app_package=app_package,
+                            files=list(base_branch.iter_files(app_package=app_package)),
+                            verbose=False,
+                        )
+                        tars_base = [
+                            cls_tar(
+                                branch=base_branch,
+                                app_package=app_package,
+                                files=files_base,
+                                mpy_cross=mpy_cross,
+                                verbose=verbose,
+                            )
+                            for cls_tar in TAR_CLASSES
+                        ]
+                    branch_tars.append((branch, tars, None, tars_base))
 
-                    index_app.add_branch(branch=branch, dict_tars=dict_tars)
+                # Write the tars in a fixed order.
+                references: Set[str] = set()
+                for branch, tars, dict_tars, tars_base in branch_tars:
+                    if dict_tars is None:
+                        dict_tars = {}
+                        for tar in tars:
+                            dict_tars.update(tar.write())
+                        for tar, tar_base in zip(tars, tars_base):
+                            dict_tars.update(tar.write_delta(tar_base=tar_base))
+                    for dict_tar in dict_tars.values():
+                        index_app.add_index(
+                            link=index_app.directory / dict_tar["link"], tag="p"
+                        )
+                        references.update(iter_links(dict_tar))
+                        if "link_files" in dict_tar:
+                            references.update(index_app.get_file_links(dict_tar))
+
+                    references.update(
+                        index_app.add_branch(branch=branch, dict_tars=dict_tars)
+                    )
+
+                # Tars of moved or deleted branches
+                index_app.remove_unreferenced(references=references)
+
+                if mqtt_broker is not None:
+                    # The devices learn about a new version without polling.
+                    with MqttPublisher(broker=mqtt_broker, verbose=verbose) as mqtt:
+                        for branch, _, _, _ in branch_tars:
+                            topic = f"{mqtt_topic_prefix}/{app_package.name}/latest/{branch.name}"
+                            dict_latest = index_app.read_latest(branch=branch)
+                            mqtt.publish_retained(
+                                topic=topic,
+                                payload=json.dumps(dict_latest).encode("ascii"),
+                            )
 
 
 if __name__ == "__main__":
@@ -306,6 +1042,28 @@ if __name__ == "__main__":
         type=bool,
         default=False,
     )
+    parser.add_argument(
+        "--incremental",
+        type=bool,
+        default=False,
+        help="Keep the tars of branches which did not move since the last run.",
+    )
+    parser.add_argument(
+        "--git-objects",
+        type=bool,
+        default=False,
+        help="Read the files from the git objects instead of checking out every branch.",
+    )
+    parser.add_argument(
+        "--mqtt-broker",
+        default=None,
+        help="'host[:port]': Publish 'latest/<branch>' as retained message to this broker.",
+    )
+    parser.add_argument(
+        "--mqtt-topic-prefix",
+        default=MQTT_TOPIC_PREFIX,
+        help="The topic is '<prefix>/<app>/latest/<branch>'.",
+    )
     parser.add_argument(
         "parent_directory",
         help=f"The parent directory to search '{FILENAME_APP_PACKAGE_PY}' files.",
@@ -318,4 +1076,8 @@ if __name__ == "__main__":
         parent_directory=parent_directory,
         verbose=args.verbose,
         no_checkout=args.no_checkout,
+        incremental=args.incremental,
+        git_objects=args.git_objects,
+        mqtt_broker=args.mqtt_broker,
+        mqtt_topic_prefix=args.mqtt_topic_prefix,
     )
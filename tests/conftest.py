@@ -0,0 +1,185 @@
+"""
+The device code in 'app_a/micropython' runs on CPython:
+The micropython modules are replaced by the stand-ins below.
+"""
+
+import asyncio
+import builtins
+import gc
+import importlib.util
+import io
+import os
+import pathlib
+import sys
+import time
+import types
+import zlib
+
+# The stdlib tarfile: Used by the packager and the tests.
+import tarfile
+
+import pytest
+
+from http_server import HttpServer
+from mqtt_broker import MqttBroker
+
+DIRECTORY_REPO = pathlib.Path(__file__).parent.parent
+DIRECTORY_MICROPYTHON = DIRECTORY_REPO / "app_a" / "micropython"
+DIRECTORY_APP_PACKAGER = DIRECTORY_REPO / "app_packager"
+# The dryer app: Only modules which do not clash with 'app_a/micropython' are imported.
+DIRECTORY_APP = DIRECTORY_REPO / "app_a" / "m1"
+
+sys.path.append(str(DIRECTORY_MICROPYTHON))
+sys.path.append(str(DIRECTORY_APP_PACKAGER))
+
+
+def _module(name: str, **attributes) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+builtins.const = lambda x: x
+time.ticks_ms = lambda: int(time.monotonic() * 1000)
+time.ticks_diff = lambda a, b: a - b
+time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+gc.mem_alloc = lambda: 0
+
+
+def _ilistdir(directory="."):
+    for entry in os.scandir(directory):
+        yield (entry.name, 0x4000 if entry.is_dir() else 0x8000, 0, entry.stat().st_size)
+
+
+os.ilistdir = _ilistdir
+
+_module("micropython", const=builtins.const, alloc_emergency_exception_buf=lambda n: None)
+machine = _module("machine", soft_resets=[])
+machine.soft_reset = lambda: machine.soft_resets.append(True)
+config_secrets = _module("config_secrets", URL_APP="http://invalid/", BRANCH="latest/main")
+_module("rp2", country=lambda country: None)
+_module("network", country=lambda country: None)
+_module(
+    "secrets",
+    MQTT_CLIENT_ID="m1",
+    MQTT_BROKER="127.0.0.1",
+    MQTT_BROKER_USER="user",
+    MQTT_BROKER_PW="secret",
+)
+
+
+class _TarHeader:
+    def __init__(self, buf):
+        self.name = bytes(buf[0:100])
+        self.size = bytes(buf[124:135])
+
+
+_module(
+    "uctypes",
+    ARRAY=0,
+    UINT8=0,
+    LITTLE_ENDIAN=0,
+    addressof=lambda buf: buf,
+    struct=lambda addr, desc, endian: _TarHeader(addr),
+)
+
+
+class _DeflateIO:
+    """
+    Behaves like micropython: The stream has to be a real stream and is read
+    through 'readinto()'. Python objects are streams only if derived from 'io.IOBase'.
+    """
+
+    def __init__(self, stream, format=0, wbits=0):
+        if not isinstance(stream, io.IOBase):
+            raise OSError("stream operation not supported")
+        self._stream = stream
+        self._decompressobj = zlib.decompressobj(wbits)
+        self._data = b""
+
+    def read(self, size=-1):
+        buf = bytearray(256)
+        while (size < 0 or len(self._data) < size) and not self._decompressobj.eof:
+            n = self._stream.readinto(buf)
+            if not n:
+                break
+            self._data += self._decompressobj.decompress(bytes(buf[:n]))
+        if size < 0:
+            size = len(self._data)
+        data, self._data = self._data[:size], self._data[size:]
+        return data
+
+    def readinto(self, buf, size=None):
+        data = self.read(len(buf) if size is None else size)
+        buf[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+_module("deflate", ZLIB=1, DeflateIO=_DeflateIO)
+
+
+def _import_device_modules() -> None:
+    """
+    The device has its own 'tarfile': It is only visible while importing the device modules.
+    """
+    spec = importlib.util.spec_from_file_location("tarfile", DIRECTORY_MICROPYTHON / "tarfile.py")
+    device_tarfile = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(device_tarfile)
+    sys.modules["tarfile"] = device_tarfile
+    try:
+        import utils_download_package
+        import utils_update
+    finally:
+        sys.modules["tarfile"] = tarfile
+
+
+_import_device_modules()
+
+
+def _import_app_module(name: str, module_name=None) -> None:
+    """
+    module_name: The app and the bootstrap both have a 'utils_wlan'.
+    """
+    module_name = module_name or name
+    spec = importlib.util.spec_from_file_location(module_name, DIRECTORY_APP / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+
+
+_import_app_module("utils_umqtt_async")
+_import_app_module("utils_influxdb")
+_import_app_module("utils_wlan", module_name="app_utils_wlan")
+
+
+@pytest.fixture
+def http_server(monkeypatch):
+    """
+    The device downloads from this server.
+    """
+    import utils_http
+
+    with HttpServer() as server:
+        monkeypatch.setattr(config_secrets, "URL_APP", server.url)
+        yield server
+        utils_http.client.close()
+
+
+@pytest.fixture
+def mqtt_broker():
+    with MqttBroker() as broker:
+        yield broker
+
+
+@pytest.fixture
+def device_directory(tmp_path, monkeypatch):
+    """
+    The filesystem of the device.
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,102 @@
+"""
+A local HTTP/1.1 stand-in for the web server the packager writes to.
+Keeps the connections alive and supports ETag/304, Range/206 and chunked bodies.
+'drop_probability' closes the connection in the middle of the bodies of 'flaky' at random.
+"""
+
+import hashlib
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+
+class _ThreadingHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address) -> None:
+        # The device closes connections in the middle of a body
+        pass
+
+
+class HttpServer:
+    def __init__(self):
+        # path (without leading '/') -> body
+        self.files: Dict[str, bytes] = {}
+        self.chunked = False
+        self.drop_probability = 0.0
+        # The paths which drop
+        self.flaky = set()
+        self.random = random.Random(0)
+        self.connections = 0
+        self.requests = 0
+        self.drops = 0
+        # The start offsets of the 'Range' requests
+        self.ranges = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                server.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server._get(self)
+
+        self._httpd = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def __enter__(self) -> "HttpServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _get(self, handler: BaseHTTPRequestHandler) -> None:
+        self.requests += 1
+        data = self.files.get(handler.path.lstrip("/"), None)
+        if data is None:
+            handler.send_response(404)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        if handler.headers.get("If-None-Match") == etag:
+            handler.send_response(304)
+            handler.send_header("ETag", etag)
+            handler.end_headers()
+            return
+        status = 200
+        range_header = handler.headers.get("Range")
+        if range_header is not None:
+            start = int(range_header.split("=")[1].split("-")[0])
+            self.ranges.append(start)
+            data = data[start:]
+            status = 206
+        handler.send_response(status)
+        handler.send_header("ETag", etag)
+        if self.chunked:
+            handler.send_header("Transfer-Encoding", "chunked")
+            handler.end_headers()
+            for i in range(0, len(data), 700):
+                chunk = data[i : i + 700]
+                handler.wfile.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+            handler.wfile.write(b"0\r\n\r\n")
+            return
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        path = handler.path.lstrip("/")
+        if (path in self.flaky) and self.random.random() < self.drop_probability:
+            self.drops += 1
+            handler.wfile.write(data[: self.random.randrange(len(data))])
+            handler.close_connection = True
+            return
+        handler.wfile.write(data)
@@ -0,0 +1,176 @@
+"""
+A local MQTT 3.1.1 stand-in for the broker of the packager and the device.
+Supports retained messages, QoS 0/1 publishes, subscriptions to exact topics and pings.
+"""
+
+import socket
+import struct
+import threading
+from typing import Dict, List, Tuple
+
+
+def _packet(header: int, data: bytes) -> bytes:
+    remaining_length = bytearray()
+    size = len(data)
+    while True:
+        size, digit = divmod(size, 128)
+        remaining_length.append(digit | (0x80 if size else 0))
+        if not size:
+            break
+    return bytes([header]) + remaining_length + data
+
+
+def _string(data: bytes) -> bytes:
+    return struct.pack("!H", len(data)) + data
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size: int) -> bytes:
+        data = self.data[self.pos : self.pos + size]
+        self.pos += size
+        return data
+
+    def string(self) -> bytes:
+        return self.read(struct.unpack("!H", self.read(2))[0])
+
+
+class MqttBroker:
+    def __init__(self):
+        # topic -> payload
+        self.retained: Dict[bytes, bytes] = {}
+        # (topic, payload, qos, retain)
+        self.published: List[Tuple[bytes, bytes, int, bool]] = []
+        # The CONNECT packets: (client_id, user, password)
+        self.connects: List[Tuple[bytes, bytes, bytes]] = []
+        self.pings = 0
+        self._lock = threading.Lock()
+        # (connection, topic)
+        self._subscriptions = []
+        self._connections = []
+        self._sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self._sock.getsockname()[1]
+        self.address = f"127.0.0.1:{self.port}"
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+
+    def __enter__(self) -> "MqttBroker":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._sock.close()
+        self.drop_connections()
+
+    def drop_connections(self) -> None:
+        """
+        Like a broker restart: All clients lose their connection.
+        """
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    # Already closed by the client
+                    pass
+                connection.close()
+            self._connections.clear()
+            self._subscriptions.clear()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                connection, _ = self._sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self._connections.append(connection)
+            threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def _receive_exactly(connection: socket.socket, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _handle(self, connection: socket.socket) -> None:
+        try:
+            while True:
+                header = self._receive_exactly(connection, 1)[0]
+                size, shift = 0, 0
+                while True:
+                    digit = self._receive_exactly(connection, 1)[0]
+                    size |= (digit & 0x7F) << shift
+                    shift += 7
+                    if not digit & 0x80:
+                        break
+                data = self._receive_exactly(connection, size)
+                if not self._process(connection, header, data):
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self._subscriptions = [s for s in self._subscriptions if s[0] is not connection]
+            connection.close()
+
+    def _process(self, connection: socket.socket, header: int, data: bytes) -> bool:
+        kind = header & 0xF0
+        reader = _Reader(data)
+        if kind == 0x10:  # CONNECT
+            # Protocol name and level
+            reader.string()
+            reader.read(1)
+            flags = reader.read(1)[0]
+            reader.read(2)
+            client_id = reader.string()
+            if flags & 0x04:
+                reader.string()
+                reader.string()
+            user = reader.string() if flags & 0x80 else None
+            password = reader.string() if flags & 0x40 else None
+            self.connects.append((client_id, user, password))
+            if (password is not None) and (user is None):
+                # MQTT 3.1.1: Protocol violation
+                connection.sendall(_packet(0x20, b"\x00\x05"))
+                return False
+            connection.sendall(_packet(0x20, b"\x00\x00"))
+        elif kind == 0x30:  # PUBLISH
+            qos = (header >> 1) & 3
+            retain = bool(header & 1)
+            topic = reader.string()
+            pid = reader.read(2) if qos else None
+            payload = data[reader.pos :]
+            self.published.append((topic, payload, qos, retain))
+            if retain:
+                self.retained[topic] = payload
+            # Acknowledged when stored
+            if qos:
+                connection.sendall(_packet(0x40, pid))
+            with self._lock:
+                subscribers = [c for c, t in self._subscriptions if t == topic]
+            for subscriber in subscribers:
+                try:
+                    subscriber.sendall(_packet(0x30, _string(topic) + payload))
+                except OSError:
+                    pass
+        elif kind == 0x80:  # SUBSCRIBE
+            pid = reader.read(2)
+            topic = reader.string()
+            with self._lock:
+                self._subscriptions.append((connection, topic))
+            connection.sendall(_packet(0x90, pid + b"\x00"))
+            if topic in self.retained:
+                connection.sendall(_packet(0x31, _string(topic) + self.retained[topic]))
+        elif kind == 0xC0:  # PINGREQ
+            self.pings += 1
+            connection.sendall(_packet(0xD0, b""))
+        elif kind == 0xE0:  # DISCONNECT
+            return False
+        return True
@@ -0,0 +1,311 @@
+import ast
+import io
+import json
+import pathlib
+import tarfile
+import types
+import zlib
+
+import git
+import pytest
+
+import app_packager
+from conftest import DIRECTORY_REPO
+
+
+def _app_package(**attributes) -> types.SimpleNamespace:
+    return types.SimpleNamespace(name="app_test", **attributes)
+
+
+def _files(sources: dict) -> list:
+    return [(pathlib.PurePosixPath(name), source.encode()) for name, source in sources.items()]
+
+
+def _imports(relative: str, source: str) -> set:
+    return set(app_packager._iter_imports(pathlib.PurePosixPath(relative), ast.parse(source)))
+
+
+def test_iter_imports_relative():
+    imports = _imports("pkg/sub/mod.py", "from . import a\nfrom ..b import c\nfrom .d import e")
+    assert imports == {
+        "pkg",
+        "pkg.sub",
+        "pkg.sub.a",
+        "pkg.b",
+        "pkg.b.c",
+        "pkg.sub.d",
+        "pkg.sub.d.e",
+    }
+    assert _imports("pkg/__init__.py", "from .x import y") >= {"pkg.x", "pkg.x.y"}
+
+
+def test_iter_imports_optional():
+    source = """
+try:
+    import utils_update
+except ImportError:
+    utils_update = None
+
+def f():
+    import deflate
+    __import__("zlib")
+"""
+    assert _imports("main.py", source) == {"utils_update", "deflate", "zlib"}
+
+
+def test_prune_unreachable():
+    files = _files(
+        {
+            "main.py": "import utils_a\ntry:\n    import utils_b\nexcept ImportError:\n    pass\n",
+            "utils_a.py": "from lib_c import x\n",
+            "utils_b.py": "",
+            "lib/lib_c.py": "",
+            "main_wlan_test.py": "import utils_a\n",
+            "config.txt": "",
+        }
+    )
+    pruned = app_packager.prune_unreachable(
+        app_package=_app_package(entry_points=["main.py"]), files=files, verbose=True
+    )
+    assert sorted(str(relative) for relative, _ in pruned) == [
+        "config.txt",
+        "lib/lib_c.py",
+        "main.py",
+        "utils_a.py",
+        "utils_b.py",
+    ]
+
+
+def test_prune_unreachable_without_entry_points():
+    files = _files({"main.py": "", "unused.py": ""})
+    assert app_packager.prune_unreachable(app_package=_app_package(), files=files, verbose=False) == files
+
+
+def test_prune_unreachable_missing_entry_point(capsys):
+    """
+    A branch without the entry point is packaged completely: The run continues.
+    """
+    files = _files({"boot.py": "", "unused.py": ""})
+    app_package = _app_package(entry_points=["main.py"])
+
+    assert app_packager.prune_unreachable(app_package=app_package, files=files, verbose=False) == files
+    assert "entry point main.py not found" in capsys.readouterr().out
+
+
+def test_prune_unreachable_syntax_error():
+    files = _files({"main.py": "import (", "unused.py": ""})
+    app_package = _app_package(entry_points=["main.py"])
+    assert app_packager.prune_unreachable(app_package=app_package, files=files, verbose=False) == files
+
+
+def test_iter_package_py_distinct_names(tmp_path):
+    """
+    Two apps with the same name would remove each other's files in 'web_downloads/<name>'.
+    """
+    for directory in ("app_x", "app_y"):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "app_package.py").write_text(
+            'import pathlib\nname = "app_x"\ndirectory = pathlib.Path(__file__).parent\nglobs = ["*.py"]\n'
+        )
+
+    with pytest.raises(AssertionError, match="name 'app_x' is already used"):
+        list(app_packager.iter_package_py(parent_directory=tmp_path))
+
+
+def test_repo_app_names_distinct():
+    apps = list(app_packager.iter_package_py(parent_directory=DIRECTORY_REPO))
+    assert sorted(app.name for app in apps) == ["app_a", "app_b"]
+
+
+APP_PACKAGE_PY = """import pathlib
+
+name = "app_t"
+directory = pathlib.Path(__file__).parent / "src"
+globs = ["*.py", "*.txt"]
+entry_points = ["main.py"]
+"""
+COMMIT_1 = {
+    "main.py": "import utils_a\nimport utils_old\n",
+    "utils_a.py": "A = 1\n",
+    "utils_old.py": "OLD = 1\n",
+    "config.txt": "1\n",
+}
+COMMIT_2 = {
+    "main.py": "import utils_a\nprint(utils_a.A)\n",
+    "utils_a.py": "A = 1\n",
+    "unused.py": "UNUSED = 1\n",
+    "config.txt": "1\n",
+}
+
+
+class _Repo:
+    """
+    A small git repo with the branch 'origin/main' and the app 'app_t'.
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self.directory_app = directory / "app_t"
+        self.directory_app.mkdir(parents=True)
+        (self.directory_app / "app_package.py").write_text(APP_PACKAGE_PY)
+        self._repo = git.Repo.init(directory)
+        self._actor = git.Actor("Tester", "tester@example.com")
+
+    def commit(self, files: dict, message: str) -> str:
+        directory_src = self.directory_app / "src"
+        if directory_src.exists():
+            self._repo.index.remove([str(directory_src)], r=True, working_tree=True)
+        directory_src.mkdir()
+        for name, source in files.items():
+            (directory_src / name).write_text(source)
+        self._repo.index.add(
+            [str(self.directory_app / "app_package.py")]
+            + [str(directory_src / name) for name in files]
+        )
+        commit = self._repo.index.commit(
+            message, author=self._actor, committer=self._actor
+        )
+        self._repo.git.update_ref("refs/remotes/origin/main", commit.hexsha)
+        return commit.hexsha
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch) -> _Repo:
+    repo = _Repo(tmp_path / "repo")
+    monkeypatch.setattr(app_packager, "DIRECTORY_REPO", repo.directory)
+    monkeypatch.setattr(app_packager, "DIRECTORY_WEB_DOWNOADS", tmp_path / "web_downloads")
+    monkeypatch.setattr(app_packager, "DIRECTORY_MPY_CROSS_CACHE", tmp_path / "mpy_cross_cache")
+    return repo
+
+
+def _package(repo: _Repo, incremental: bool) -> pathlib.Path:
+    app_packager.main(
+        parent_directory=repo.directory,
+        verbose=False,
+        no_checkout=False,
+        incremental=incremental,
+        git_objects=True,
+    )
+    return app_packager.DIRECTORY_WEB_DOWNOADS / "app_t"
+
+
+def _tar_names(data: bytes) -> list:
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return tar.getnames()
+
+
+def _read_manifest(data: bytes) -> dict:
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return json.load(tar.extractfile(app_packager.FILENAME_MANIFEST))
+
+
+def test_package_two_commits(repo):
+    """
+    The deploy workflow: No 'web_downloads' of a last run, the delta is based on the parent commit.
+    """
+    sha_1 = repo.commit(COMMIT_1, "commit 1")
+    sha_2 = repo.commit(COMMIT_2, "commit 2")
+
+    directory = _package(repo=repo, incremental=False)
+
+    index_top = (app_packager.DIRECTORY_WEB_DOWNOADS / "index.html").read_text()
+    assert 'href="app_t"' in index_top
+    index = (directory / "index.html").read_text()
+    assert "latest/main" in index
+    assert "commit 2" in index
+    assert (directory / "latest" / "main.sha").read_text() == sha_2
+
+    dict_latest = json.loads((directory / "latest" / "main").read_text())
+    assert dict_latest["commit_sha"] == sha_2
+    dict_tars = dict_latest["dict_tars"]
+    assert sorted(dict_tars) == [
+        "mpy_version/6.1",
+        "mpy_version/6.1/delta",
+        "mpy_version/6.1/delta/zlib",
+        "mpy_version/6.1/files",
+        "mpy_version/6.1/zlib",
+        "src",
+        "src/delta",
+        "src/delta/zlib",
+        "src/files",
+        "src/zlib",
+    ]
+    for dict_tar in dict_tars.values():
+        assert "<p>" + dict_tar["link"] in index
+        assert (directory / dict_tar["link"]).stat().st_size == dict_tar["size_bytes"]
+
+    # The full tar: 'unused.py' is not imported from 'main.py'.
+    data = (directory / dict_tars["src"]["link"]).read_bytes()
+    assert _tar_names(data) == ["main.py", "utils_a.py", "config.txt", app_packager.FILENAME_MANIFEST]
+    data_zlib = (directory / dict_tars["src/zlib"]["link"]).read_bytes()
+    assert zlib.decompress(data_zlib, app_packager.TAR_ZLIB_WBITS) == data
+    data_mpy = (directory / dict_tars["mpy_version/6.1"]["link"]).read_bytes()
+    # Only the python modules are compiled.
+    assert _tar_names(data_mpy) == ["main.mpy", "utils_a.mpy", "config.txt", app_packager.FILENAME_MANIFEST]
+    with tarfile.open(fileobj=io.BytesIO(data_mpy)) as tar:
+        assert tar.extractfile("main.mpy").read()[:1] == b"M"
+        assert tar.extractfile("config.txt").read() == b"1\n"
+
+    # The delta: Only the changed files, 'utils_old.py' is deleted.
+    for version in ("src", "mpy_version/6.1"):
+        dict_delta = dict_tars[version + "/delta"]
+        assert dict_delta["base_commit_sha"] == sha_1
+        assert dict_delta["link"] == f"{version}/delta/{sha_1}_{sha_2}.tar"
+        data = (directory / dict_delta["link"]).read_bytes()
+        suffix = app_packager.TarMpyCross.py_suffix if version != "src" else ".py"
+        assert dict_delta["deleted"] == ["utils_old" + suffix]
+        assert _tar_names(data) == ["main" + suffix, app_packager.FILENAME_MANIFEST]
+        dict_manifest = _read_manifest(data)
+        assert dict_manifest["deleted"] == ["utils_old" + suffix]
+        assert dict_manifest["files"] == ["main" + suffix, "utils_a" + suffix, "config.txt"]
+
+    # The manifest of the per-file download
+    dict_files = dict_tars["src/files"]
+    dict_manifest = json.loads((directory / dict_files["link"]).read_text())
+    for name, dict_file in dict_manifest["dict_files"].items():
+        data = (directory / (dict_files["link_files"] + dict_file["sha256"])).read_bytes()
+        assert data == COMMIT_2[name].encode()
+
+
+def test_package_incremental(repo):
+    """
+    The delta is based on the commit of the last run and the files of the last run are removed.
+    """
+    sha_1 = repo.commit(COMMIT_1, "commit 1")
+    directory = _package(repo=repo, incremental=True)
+    dict_tars_1 = json.loads((directory / "latest" / "main").read_text())["dict_tars"]
+    assert "src/delta" not in dict_tars_1
+    mtime = (directory / dict_tars_1["src"]["link"]).stat().st_mtime_ns
+
+    # The branch did not move: The tars are reused.
+    _package(repo=repo, incremental=True)
+    assert (directory / dict_tars_1["src"]["link"]).stat().st_mtime_ns == mtime
+    stale = directory / "src" / "stale.tar"
+    stale.write_bytes(b"")
+
+    repo.commit(COMMIT_2, "commit 2a")
+    sha_2 = repo.commit({**COMMIT_2, "config.txt": "2\n"}, "commit 2b")
+    _package(repo=repo, incremental=True)
+
+    dict_tars_2 = json.loads((directory / "latest" / "main").read_text())["dict_tars"]
+    dict_delta = dict_tars_2["src/delta"]
+    assert dict_delta["base_commit_sha"] == sha_1
+    assert dict_delta["deleted"] == ["utils_old.py"]
+    data = (directory / dict_delta["link"]).read_bytes()
+    assert _tar_names(data) == ["main.py", "config.txt", app_packager.FILENAME_MANIFEST]
+
+    # 'remove_unreferenced()': The tars of commit 1 and unknown files are gone.
+    assert not stale.exists()
+    for dict_tar in dict_tars_1.values():
+        for link in app_packager.iter_links(dict_tar):
+            assert not (directory / link).exists(), link
+    for dict_tar in dict_tars_2.values():
+        for link in app_packager.iter_links(dict_tar):
+            assert (directory / link).is_file(), link
+    files = {
+        file.relative_to(directory).as_posix()
+        for file in directory.rglob("*")
+        if file.is_file()
+    }
+    assert f"src/{sha_2}.tar" in files
+    assert not any(sha_1 + ".tar" in file or sha_1 + ".json" in file for file in files)
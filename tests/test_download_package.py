@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import io
+import json
+import tarfile
+import zlib
+
+import pytest
+
+import utils_download_package
+import utils_http
+
+FILES = {
+    "main.py": b"print('main')\n",
+    "big.py": bytes(range(256)) * 40,
+}
+
+
+def _tar(files: dict) -> bytes:
+    """
+    Like 'TarSrc._write_tar()' of the packager.
+    """
+    f = io.BytesIO()
+    with tarfile.open(name="app.tar", mode="w", fileobj=f) as tar:
+        for name, data in files.items():
+            tarinfo = tarfile.TarInfo(name=name)
+            tarinfo.size = len(data)
+            tar.addfile(tarinfo, io.BytesIO(data))
+    return f.getvalue()[: tar.offset]
+
+
+def _publish(http_server, link: str, data: bytes, **dict_tar) -> dict:
+    http_server.files[link] = data
+    dict_tar.update(link=link, sha256=hashlib.sha256(data).hexdigest(), size_bytes=len(data))
+    return dict_tar
+
+
+def _assert_staged(names: list, files=FILES) -> None:
+    assert sorted(names) == sorted(files)
+    for name, data in files.items():
+        with open(f"{utils_download_package.STAGING_DIRECTORY}/{name}", "rb") as f:
+            assert f.read() == data
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_streaming(http_server, device_directory, compressed, capsys):
+    data = _tar(FILES)
+    if compressed:
+        compressobj = zlib.compressobj(wbits=10)
+        data_zlib = compressobj.compress(data) + compressobj.flush()
+        dict_tar = _publish(http_server, "app.tar.zlib", data_zlib, compression="zlib", wbits=10)
+    else:
+        dict_tar = _publish(http_server, "app.tar", data)
+
+    names = utils_download_package.prepare_new_version(dict_tar, streaming=True)
+
+    _assert_staged(names)
+    assert "kB/s, buffer 1024 bytes, heap allocated" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_saved(http_server, device_directory, compressed, capsys):
+    """
+    The tar is saved to TAR_FILENAME first, then extracted.
+    """
+    data = _tar(FILES)
+    if compressed:
+        compressobj = zlib.compressobj(wbits=10)
+        data_zlib = compressobj.compress(data) + compressobj.flush()
+        dict_tar = _publish(http_server, "app.tar.zlib", data_zlib, compression="zlib", wbits=10)
+    else:
+        dict_tar = _publish(http_server, "app.tar", data)
+
+    names = utils_download_package.prepare_new_version(dict_tar, streaming=False, buffer_bytes=512)
+
+    _assert_staged(names)
+    assert "kB/s, buffer 512 bytes, heap allocated" in capsys.readouterr().out
+
+
+# Like app_b: The packager writes no directory members.
+NESTED_FILES = {
+    "main.py": b"print('main')\n",
+    "lib/b3.py": bytes(range(256)) * 8,
+    utils_download_package.FILENAME_MANIFEST: json.dumps({"files": ["main.py", "lib/b3.py"]}).encode(),
+}
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize("compressed", [False, True])
+def test_nested(http_server, device_directory, streaming, compressed):
+    data = _tar(NESTED_FILES)
+    if compressed:
+        compressobj = zlib.compressobj(wbits=10)
+        data_zlib = compressobj.compress(data) + compressobj.flush()
+        dict_tar = _publish(http_server, "app.tar.zlib", data_zlib, compression="zlib", wbits=10)
+    elif streaming:
+        dict_tar = _publish(http_server, "app.tar", data)
+    else:
+        # Saved and extracted using the member index
+        dict_tar = _publish_resumable(http_server, data)
+
+    names = utils_download_package.prepare_new_version(dict_tar, streaming=streaming)
+
+    _assert_staged(names, NESTED_FILES)
+
+
+def test_activate_nested(http_server, device_directory):
+    """
+    The obsolete files and directories are removed, 'lib' stays.
+    """
+    (device_directory / "obsolete.py").write_text("")
+    (device_directory / "obsolete").mkdir()
+    (device_directory / "obsolete" / "x.py").write_text("")
+    dict_tar = _publish(http_server, "app.tar", _tar(NESTED_FILES))
+    names = utils_download_package.prepare_new_version(dict_tar, streaming=True)
+
+    utils_download_package.activate_new_version(names)
+
+    assert sorted(p.name for p in device_directory.iterdir()) == sorted(
+        ["main.py", "lib", utils_download_package.FILENAME_MANIFEST, utils_download_package.FILENAME_METRICS]
+    )
+    assert (device_directory / "lib" / "b3.py").read_bytes() == NESTED_FILES["lib/b3.py"]
+
+
+def test_streaming_sha256_mismatch(http_server, device_directory):
+    dict_tar = _publish(http_server, "app.tar", _tar(FILES))
+    dict_tar["sha256"] = "0" * 64
+
+    assert utils_download_package.prepare_new_version(dict_tar, streaming=True) is None
+    assert not (device_directory / utils_download_package.STAGING_DIRECTORY).exists()
+
+
+def _publish_resumable(http_server, data: bytes, chunk_size=1024) -> dict:
+    """
+    Like 'TarSrc._write_chunks()' of the packager.
+    """
+    dict_tar = _publish(http_server, "app_resumable.tar", data)
+    lines = [
+        hashlib.sha256(data[i : i + chunk_size]).hexdigest() + "\n"
+        for i in range(0, len(data), chunk_size)
+    ]
+    http_server.files["app_resumable.tar.chunks"] = "".join(lines).encode()
+    dict_tar.update(chunk_size=chunk_size, link_chunks="app_resumable.tar.chunks")
+    return dict_tar
+
+
+def test_resumable_random_drops(http_server, device_directory, monkeypatch):
+    """
+    The connection drops at random positions: Every download has to complete.
+    """
+    monkeypatch.setattr(utils_download_package, "DOWNLOAD_RETRIES", 50)
+    data = bytes(http_server.random.randrange(256) for _ in range(20000))
+    dict_tar = _publish_resumable(http_server, data)
+    http_server.flaky.add("app_resumable.tar")
+    http_server.drop_probability = 0.5
+
+    for seed in range(10):
+        http_server.random.seed(seed)
+        (device_directory / utils_download_package.TAR_FILENAME).unlink(missing_ok=True)
+
+        assert utils_download_package._save_resumable(dict_tar, bytearray(512))
+
+        assert (device_directory / utils_download_package.TAR_FILENAME).read_bytes() == data
+        assert not (device_directory / utils_download_package.FILENAME_CHECKPOINT).exists()
+    assert http_server.drops > 0
+    assert any(offset > 0 for offset in http_server.ranges)
+
+
+def test_resumable_after_reboot(http_server, device_directory, monkeypatch):
+    data = bytes(range(256)) * 80
+    dict_tar = _publish_resumable(http_server, data)
+
+    # Every download drops: The retries are exhausted, the checkpoint remains.
+    monkeypatch.setattr(utils_download_package, "DOWNLOAD_RETRIES", 3)
+    http_server.flaky.add("app_resumable.tar")
+    http_server.drop_probability = 1.0
+    assert not utils_download_package._save_resumable(dict_tar, bytearray(512))
+    assert (device_directory / utils_download_package.FILENAME_CHECKPOINT).exists()
+
+    # After the reboot, the download continues at the checkpoint.
+    http_server.drop_probability = 0.0
+    http_server.ranges.clear()
+    assert utils_download_package._save_resumable(dict_tar, bytearray(512))
+    assert http_server.ranges[0] > 0
+    assert (device_directory / utils_download_package.TAR_FILENAME).read_bytes() == data
+
+
+def test_resumable_corrupt_chunk(http_server, device_directory, monkeypatch):
+    """
+    A chunk which does not match its sha256 is downloaded again.
+    """
+    monkeypatch.setattr(utils_download_package, "DOWNLOAD_RETRIES", 3)
+    data = bytes(range(256)) * 20
+    dict_tar = _publish_resumable(http_server, data)
+    http_server.files["app_resumable.tar"] = data[:2000] + b"x" + data[2001:]
+
+    assert not utils_download_package._save_resumable(dict_tar, bytearray(512))
+    checkpoint = (device_directory / utils_download_package.FILENAME_CHECKPOINT).read_text()
+    assert '"offset": 1024' in checkpoint
+
+
+class _Mqtt:
+    """
+    Like 'utils_wlan.MQTT': 'publish_annotation()' returns False if not acknowledged.
+    """
+
+    def __init__(self):
+        self.acknowledged = False
+        self.annotations = []
+
+    async def publish_annotation(self, title: str, text: str, severity="INFO", qos=0) -> bool:
+        assert qos == 1
+        self.annotations.append(text)
+        return self.acknowledged
+
+
+def test_publish_metrics(device_directory):
+    mqtt = _Mqtt()
+    assert asyncio.run(utils_download_package.publish_metrics(mqtt))
+    assert mqtt.annotations == []
+
+    metrics = utils_download_package.Metrics()
+    metrics.link = "app.tar"
+    metrics.phases = {"download": [100, 2000], "cleanup": [5, 3]}
+    metrics.save()
+
+    # Not connected: The metrics are kept.
+    assert not asyncio.run(utils_download_package.publish_metrics(mqtt))
+    assert (device_directory / utils_download_package.FILENAME_METRICS).exists()
+
+    mqtt.acknowledged = True
+    assert asyncio.run(utils_download_package.publish_metrics(mqtt))
+    assert not (device_directory / utils_download_package.FILENAME_METRICS).exists()
+    assert mqtt.annotations[-1] == (
+        "app.tar: download 100ms 2000B, cleanup 5ms 3 files, 0B unchanged, peak heap 0B, retries 0"
+    )
+
+
+@pytest.mark.parametrize("truncate", [True, False])
+def test_resumable_truncated_tar(http_server, device_directory, truncate):
+    """
+    The checkpoint is only trusted if the partial tar is long enough.
+    """
+    data = bytes(range(256)) * 80
+    dict_tar = _publish_resumable(http_server, data)
+    utils_download_package._write_checkpoint(dict_tar, 4096)
+    tar = device_directory / utils_download_package.TAR_FILENAME
+    if truncate:
+        tar.write_bytes(data[:100])
+
+    assert utils_download_package._save_resumable(dict_tar, bytearray(512))
+    assert http_server.ranges == [0]
+    assert tar.read_bytes() == data
+
+
+def test_files_skipped(http_server, device_directory):
+    """
+    Only the changed files are downloaded: The metrics count the unchanged bytes.
+    """
+
+    def manifest(files: dict) -> bytes:
+        dict_files = {
+            name: dict(sha256=hashlib.sha256(data).hexdigest(), size_bytes=len(data))
+            for name, data in files.items()
+        }
+        return json.dumps(dict(files=list(files), dict_files=dict_files)).encode()
+
+    installed = dict(FILES, **{"big.py": b"old"})
+    (device_directory / utils_download_package.FILENAME_MANIFEST).write_bytes(manifest(installed))
+    for data in FILES.values():
+        http_server.files[f"files/{hashlib.sha256(data).hexdigest()}"] = data
+    dict_tar = _publish(http_server, "app_files.json", manifest(FILES), link_files="files/")
+    metrics = utils_download_package.metrics
+    metrics.reset()
+
+    names = utils_download_package.prepare_new_version(dict_tar)
+
+    assert names == ["big.py", utils_download_package.FILENAME_MANIFEST]
+    assert metrics.bytes_written == len(FILES["big.py"])
+    assert metrics.bytes_skipped == len(FILES["main.py"])
+
+
+def test_resumable_full_reads(http_server, device_directory, monkeypatch, capsys):
+    """
+    The buffer divides the chunks: Every read but the last gets 'buf' itself, no slice.
+    """
+    reads = []
+    readinto = utils_http._Body.readinto
+
+    def spy(body, b, size=None):
+        if size is not None:
+            # Not the '.chunks' read by 'response.text'
+            reads.append((b is buf, size))
+        return readinto(body, b, size)
+
+    monkeypatch.setattr(utils_http._Body, "readinto", spy)
+    data = bytes(range(256)) * 20 + b"tail"
+    dict_tar = _publish_resumable(http_server, data)
+    buf = bytearray(512)
+
+    assert utils_download_package._save_resumable(dict_tar, buf)
+
+    assert all(is_buf for is_buf, _ in reads)
+    assert [size for _, size in reads].count(512) == len(data) // 512
+    assert "app_resumable.tar: 5124 bytes in" in capsys.readouterr().out
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import io
+import json
+import tarfile
+
+import pytest
+
+import app_packager
+import utils_download_package
+import utils_umqtt_async
+import utils_update
+
+TOPIC = "app_packager/app_a/latest/main"
+
+
+@pytest.mark.parametrize(
+    "user, password, expected",
+    [
+        (None, None, (None, None)),
+        ("user", None, (b"user", None)),
+        ("user", "secret", (b"user", b"secret")),
+        # A password without a user is not sent.
+        (None, "secret", (None, None)),
+    ],
+)
+def test_credentials(mqtt_broker, monkeypatch, user, password, expected):
+    for name, value in (("APP_PACKAGER_MQTT_USER", user), ("APP_PACKAGER_MQTT_PASSWORD", password)):
+        if value is None:
+            monkeypatch.delenv(name, raising=False)
+        else:
+            monkeypatch.setenv(name, value)
+
+    with app_packager.MqttPublisher(broker=mqtt_broker.address, verbose=False):
+        pass
+
+    assert mqtt_broker.connects[0][1:] == expected
+
+
+def test_publish_retained(mqtt_broker):
+    with app_packager.MqttPublisher(broker=mqtt_broker.address, verbose=False) as mqtt:
+        mqtt.publish_retained(TOPIC, b"first")
+        mqtt.publish_retained(TOPIC, b"second")
+
+    assert mqtt_broker.retained == {TOPIC.encode(): b"second"}
+    assert [qos for _, _, qos, _ in mqtt_broker.published] == [1, 1]
+
+
+class _Wlan:
+    def connect(self) -> None:
+        pass
+
+
+def _latest_package(http_server) -> dict:
+    f = io.BytesIO()
+    with tarfile.open(name="app.tar", mode="w", fileobj=f) as tar:
+        data = b"print('main')\n"
+        tarinfo = tarfile.TarInfo(name="main.py")
+        tarinfo.size = len(data)
+        tar.addfile(tarinfo, io.BytesIO(data))
+    data = f.getvalue()[: tar.offset]
+    http_server.files["app.tar"] = data
+    dict_tar = dict(link="app.tar", sha256=hashlib.sha256(data).hexdigest(), size_bytes=len(data))
+    return dict(commit_sha="abc", commit_pretty="abc: main", dict_tars={"src": dict_tar})
+
+
+def test_updater_push(mqtt_broker, http_server, device_directory):
+    """
+    The packager publishes 'latest/<branch>' retained: The device subscribes after the
+    publish, receives the document in 'Updater.notify()' and stages the new version.
+    """
+    with app_packager.MqttPublisher(broker=mqtt_broker.address, verbose=False) as mqtt:
+        mqtt.publish_retained(TOPIC, json.dumps(_latest_package(http_server)).encode("ascii"))
+
+    updater = utils_update.Updater(_Wlan(), tar_version="src", push=True)
+
+    async def subscribe():
+        client = utils_umqtt_async.MQTTClient("device", "127.0.0.1", port=mqtt_broker.port)
+        client.set_callback(lambda topic, msg: updater.notify(msg))
+        await client.connect()
+        await client.subscribe(TOPIC)
+        while updater._latest_package is None:
+            await asyncio.sleep(0.01)
+        await client.disconnect()
+
+    asyncio.run(asyncio.wait_for(subscribe(), 5))
+    updater.run()
+
+    assert updater.ready
+    assert (device_directory / utils_download_package.STAGING_DIRECTORY / "main.py").exists()
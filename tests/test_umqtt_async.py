@@ -0,0 +1,203 @@
+import asyncio
+
+import pytest
+
+import app_utils_wlan
+import utils_umqtt_async
+
+TOPIC = b"filament_dryer/m1/statemachine"
+
+
+def _run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+
+def _client(mqtt_broker, messages: list, **kwargs) -> utils_umqtt_async.MQTTClient:
+    client = utils_umqtt_async.MQTTClient("m1", "127.0.0.1", port=mqtt_broker.port, **kwargs)
+    client.set_callback(lambda topic, msg: messages.append((topic, msg)))
+    return client
+
+
+def test_retained_after_subscribe(mqtt_broker):
+    """
+    The retained message arrives right after the SUBACK: 'wait_msg()' must not miss it.
+    """
+    mqtt_broker.retained[TOPIC] = b"dry"
+    messages = []
+
+    async def main():
+        client = _client(mqtt_broker, messages)
+        await client.connect()
+        await client.subscribe(TOPIC)
+        # Give the background task the time to deliver the retained message
+        await asyncio.sleep(0.1)
+        await client.wait_msg()
+        await client.disconnect()
+
+    _run(main())
+    assert messages == [(TOPIC, b"dry")]
+
+
+def test_wait_msg(mqtt_broker):
+    messages = []
+
+    async def main():
+        client = _client(mqtt_broker, messages)
+        sender = _client(mqtt_broker, [])
+        await client.connect()
+        await client.subscribe(TOPIC)
+        await sender.connect()
+        for msg in (b"off", b"dry"):
+            await sender.publish(TOPIC, msg)
+        for _ in range(2):
+            await client.wait_msg()
+        await sender.disconnect()
+        await client.disconnect()
+
+    _run(main())
+    assert messages == [(TOPIC, b"off"), (TOPIC, b"dry")]
+
+
+def test_publish_qos1(mqtt_broker):
+    async def main():
+        client = _client(mqtt_broker, [], user="user", password="secret")
+        await client.connect()
+        await client.publish(b"forward2influxdb", b"payload", qos=1)
+        await client.disconnect()
+
+    _run(main())
+    assert mqtt_broker.connects == [(b"m1", b"user", b"secret")]
+    assert mqtt_broker.published == [(b"forward2influxdb", b"payload", 1, False)]
+
+
+def test_keepalive(mqtt_broker):
+    async def main():
+        client = _client(mqtt_broker, [], keepalive=1)
+        await client.connect()
+        await asyncio.sleep(1.2)
+        client.check_msg()
+        await client.disconnect()
+
+    _run(main())
+    assert mqtt_broker.pings >= 2
+
+
+def test_connection_lost(mqtt_broker):
+    async def main():
+        client = _client(mqtt_broker, [])
+        await client.connect()
+        await client.subscribe(TOPIC)
+        mqtt_broker.drop_connections()
+        with pytest.raises(OSError):
+            await client.wait_msg()
+        with pytest.raises(OSError):
+            client.check_msg()
+        with pytest.raises(OSError):
+            await client.publish(TOPIC, b"off")
+
+    _run(main())
+
+
+class _Wlan:
+    """
+    Like 'utils_wlan.WLAN' once connected.
+    """
+
+    def __init__(self):
+        self.connection_counter = 1
+        self.selection = None
+        self.power_offs = 0
+        self.connected = True
+
+    def tick(self) -> bool:
+        return self.connected
+
+    def scan(self) -> None:
+        pass
+
+    def register_event_cb(self, cb) -> None:
+        pass
+
+    def _wdt_feed(self) -> None:
+        pass
+
+    def power_off(self) -> None:
+        self.power_offs += 1
+
+
+def test_app_mqtt(mqtt_broker, monkeypatch):
+    """
+    'utils_wlan.MQTT' of the dryer: Commands are received while publishing.
+    """
+    monkeypatch.setattr(
+        app_utils_wlan,
+        "MQTTClient",
+        lambda *args, **kwargs: utils_umqtt_async.MQTTClient(*args, port=mqtt_broker.port, **kwargs),
+    )
+    wlan = _Wlan()
+    commands = []
+    mqtt = app_utils_wlan.MQTT(wlan)
+    mqtt.register_callback("statemachine", commands.append)
+
+    async def main():
+        assert await mqtt.publish(fields={"temperature_C": "23.5"}, tags={})
+        sender = _client(mqtt_broker, [])
+        await sender.connect()
+        await sender.publish(TOPIC, b"dry")
+        # The INITIAL_VALUE published by 'connect()' is received too
+        while not commands:
+            await mqtt.client.wait_msg()
+        assert await mqtt.publish_annotation(title="Update", text="done", qos=1)
+        await sender.disconnect()
+
+        # The broker restarts: Reported, the wlan is power cycled.
+        mqtt_broker.drop_connections()
+        await asyncio.sleep(0.1)
+        assert not await mqtt.publish(fields={"temperature_C": "23.5"}, tags={})
+        assert wlan.power_offs == 1
+
+    _run(main())
+    assert commands == ["dry"]
+    assert mqtt_broker.connects[0] == (b"m1", b"user", b"secret")
+    topics = [topic for topic, _, _, _ in mqtt_broker.published]
+    assert topics[:2] == [TOPIC, b"forward2influxdb"]
+    assert mqtt_broker.published[-1][2] == 1
+
+
+def test_app_mqtt_queue(mqtt_broker, monkeypatch):
+    """
+    The control loop queues, the task 'run()' publishes: Also the messages
+    queued while the network was down, the oldest are dropped.
+    """
+    monkeypatch.setattr(
+        app_utils_wlan,
+        "MQTTClient",
+        lambda *args, **kwargs: utils_umqtt_async.MQTTClient(*args, port=mqtt_broker.port, **kwargs),
+    )
+    monkeypatch.setattr(app_utils_wlan, "MQTT_QUEUE_LENGTH", 3)
+    wlan = _Wlan()
+    wlan.connected = False
+    mqtt = app_utils_wlan.MQTT(wlan)
+
+    def payloads() -> list:
+        return [payload for topic, payload, _, _ in mqtt_broker.published if topic == b"forward2influxdb"]
+
+    async def main():
+        task = asyncio.create_task(mqtt.run())
+        for i in range(4):
+            mqtt.queue(fields={"i": str(i)}, tags={})
+        mqtt.queue_annotation(title="Statechange", text="dry")
+        await asyncio.sleep(0.3)
+        assert payloads() == []
+
+        wlan.connected = True
+        while len(payloads()) < 3:
+            await asyncio.sleep(0.05)
+        task.cancel()
+
+    _run(main())
+    published = payloads()
+    assert len(published) == 3
+    assert b"i=2" in published[0]
+    assert b"i=3" in published[1]
+    assert b"annotation" in published[2]
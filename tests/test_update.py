@@ -0,0 +1,46 @@
+import pytest
+
+import utils_update
+
+
+class _Wlan:
+    def connect(self) -> None:
+        pass
+
+
+def test_new_version_available_missing(http_server, device_directory):
+    """
+    Nothing is published: An OSError which the updater retries.
+    """
+    with pytest.raises(OSError, match="status_code=404"):
+        utils_update.new_version_available()
+
+
+def test_run_survives_errors(monkeypatch):
+    """
+    Whatever 'poll()' raises: The thread keeps polling until a version is staged.
+    """
+    errors = [OSError("connection reset"), ValueError("broken json"), KeyError("dict_tars")]
+
+    def poll(latest_package=None):
+        if errors:
+            raise errors.pop(0)
+        return True
+
+    updater = utils_update.Updater(_Wlan())
+    monkeypatch.setattr(updater, "poll", poll)
+    monkeypatch.setattr(updater._scheduler, "sleep", lambda: None)
+
+    updater.run()
+
+    assert errors == []
+
+
+def test_notify_broken_document():
+    updater = utils_update.Updater(_Wlan(), push=True)
+
+    updater.notify(b"{broken")
+    assert updater._latest_package is None
+
+    updater.notify(b'{"commit_sha": "abc"}')
+    assert updater._latest_package == {"commit_sha": "abc"}
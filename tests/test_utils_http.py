@@ -0,0 +1,110 @@
+import hashlib
+
+import pytest
+
+import utils_http
+
+DATA = bytes(range(256)) * 10
+
+
+@pytest.fixture
+def client(http_server):
+    http_server.files["data.bin"] = DATA
+    http_server.files["empty.bin"] = b""
+    client = utils_http.HttpClient()
+    yield client
+    client.close()
+
+
+def test_keep_alive(http_server, client):
+    for _ in range(3):
+        response = client.get(http_server.url + "data.bin")
+        assert response.status_code == 200
+        assert response.content == DATA
+    response = client.get(http_server.url + "empty.bin")
+    assert response.content == b""
+
+    assert http_server.requests == 4
+    assert http_server.connections == 1
+    assert client.bytes_received == 3 * len(DATA)
+
+
+def test_not_found(http_server, client):
+    response = client.get(http_server.url + "missing.bin")
+    assert response.status_code == 404
+    response.close()
+    assert client.get(http_server.url + "data.bin").content == DATA
+    assert http_server.connections == 1
+
+
+def test_not_modified(http_server, client):
+    response = client.get(http_server.url + "data.bin")
+    assert response.content == DATA
+    etag = response.headers["ETag"]
+
+    response = client.get(http_server.url + "data.bin", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.raw.done
+    assert response.content == b""
+
+    # The 304 has no body: The connection is reused.
+    assert client.get(http_server.url + "data.bin").content == DATA
+    assert http_server.connections == 1
+
+
+def test_range(http_server, client):
+    response = client.get(http_server.url + "data.bin", headers={"Range": "bytes=1000-"})
+    assert response.status_code == 206
+    assert response.content == DATA[1000:]
+    assert http_server.ranges == [1000]
+
+
+def test_close_unread(http_server, client):
+    """
+    A body which was not read cannot be skipped: The next request needs a new connection.
+    """
+    client.get(http_server.url + "data.bin").close()
+    assert client.get(http_server.url + "data.bin").content == DATA
+    assert http_server.connections == 2
+
+
+def test_chunked(http_server, client):
+    http_server.chunked = True
+
+    for _ in range(2):
+        response = client.get(http_server.url + "data.bin")
+        assert response.status_code == 200
+        assert response.content == DATA
+    assert http_server.connections == 1
+
+
+def test_chunked_readinto(http_server, client):
+    """
+    The buffer does not align with the chunks of 700 bytes.
+    """
+    http_server.chunked = True
+    response = client.get(http_server.url + "data.bin")
+    buf = bytearray(512)
+    sha256 = hashlib.sha256()
+    while True:
+        n = response.raw.readinto(buf)
+        if not n:
+            break
+        sha256.update(buf[:n])
+    assert sha256.digest() == hashlib.sha256(DATA).digest()
+
+
+def test_dropped_connection(http_server, client):
+    """
+    The server closes the connection in the middle of the body.
+    """
+    http_server.flaky.add("data.bin")
+    http_server.drop_probability = 1.0
+    response = client.get(http_server.url + "data.bin")
+    with pytest.raises(OSError):
+        response.raw.read()
+    response.close()
+
+    http_server.drop_probability = 0.0
+    assert client.get(http_server.url + "data.bin").content == DATA
+    assert http_server.connections == 2
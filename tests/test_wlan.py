@@ -0,0 +1,128 @@
+import threading
+import time
+import types
+
+import pytest
+
+import app_utils_wlan
+
+SSID = b"ssid"
+BSSID = b"\x01\x02\x03\x04\x05\x06"
+
+
+class _Driver:
+    """
+    Like 'network.WLAN': Records the calls.
+    """
+
+    PM_PERFORMANCE = 0
+
+    def __init__(self, interface):
+        self.calls = []
+        self.connected = False
+        self._active = False
+
+    def config(self, **kwargs) -> None:
+        pass
+
+    def active(self, active=None):
+        if active is None:
+            return self._active
+        self.calls.append(f"active({active})")
+        self._active = active
+
+    def deinit(self) -> None:
+        self.calls.append("deinit")
+
+    def disconnect(self) -> None:
+        self.calls.append("disconnect")
+        self.connected = False
+
+    def scan(self) -> list:
+        self.calls.append("scan")
+        # (ssid, bssid, channel, RSSI, security, hidden)
+        return [(SSID, BSSID, 6, -50, 3, 0)]
+
+    def connect(self, ssid, password, bssid=None, channel=0) -> None:
+        self.calls.append("connect")
+
+    def isconnected(self) -> bool:
+        return self.connected
+
+    def status(self, param=None) -> int:
+        if param == "rssi":
+            return -50
+        return 3 if self.connected else 1
+
+    def ifconfig(self) -> tuple:
+        return ("192.168.0.2" if self.connected else "0.0.0.0",)
+
+
+@pytest.fixture
+def wlan(monkeypatch) -> app_utils_wlan.WLAN:
+    network = types.SimpleNamespace(
+        WLAN=_Driver, STA_IF=0, STAT_CONNECTING=1, STAT_GOT_IP=3
+    )
+    monkeypatch.setattr(app_utils_wlan, "network", network)
+    monkeypatch.setattr(
+        app_utils_wlan.secrets, "SSID_CREDENTIALS", [(SSID, "password")], raising=False
+    )
+    monkeypatch.setattr(app_utils_wlan, "WLAN_POWER_OFF_MS", 0)
+    return app_utils_wlan.WLAN()
+
+
+def _wait_for(condition) -> None:
+    end_s = time.monotonic() + 2.0
+    while not condition():
+        assert time.monotonic() < end_s
+        time.sleep(0.01)
+
+
+def test_power_off_while_connecting(wlan):
+    """
+    The updater connects on the second core: The control loop must not power off
+    below the running attempt.
+    """
+    driver = wlan._wlan
+    results = []
+    thread = threading.Thread(target=lambda: results.append(wlan.connect()))
+    thread.start()
+    try:
+        _wait_for(lambda: "connect" in driver.calls)
+        calls = len(driver.calls)
+        wlan.power_off()
+        assert not wlan.tick()
+        assert driver.calls[calls:] == []
+    finally:
+        driver.connected = True
+        thread.join(2.0)
+    assert results == [True]
+    assert wlan.tick()
+
+    wlan.power_off()
+    assert driver.calls[-3:] == ["disconnect", "active(False)", "deinit"]
+
+
+def test_tick_does_not_scan(wlan):
+    """
+    'tick()' runs in the control loop: The blocking power on and scan are left to 'scan()'.
+    """
+    driver = wlan._wlan
+    for _ in range(3):
+        assert not wlan.tick()
+    assert wlan.state == app_utils_wlan.STATE_SCANNING
+    assert "scan" not in driver.calls
+    assert "active(True)" not in driver.calls
+
+    wlan.scan()
+    assert driver.calls[-2:] == ["active(True)", "scan"]
+    # Nothing more to do for 'scan()'
+    wlan.scan()
+    assert driver.calls[-2:] == ["active(True)", "scan"]
+
+    assert not wlan.tick()
+    assert wlan.state == app_utils_wlan.STATE_ASSOCIATING
+    assert driver.calls[-1] == "connect"
+    driver.connected = True
+    assert wlan.tick()
+    assert wlan.selection["bssid"] == "010203040506"